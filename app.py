@@ -36,6 +36,7 @@ from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.rtcrtpsender import RTCRtpSender
 from webrtc import HumanPlayer
 from basereal import BaseReal
+from avatarregistry import AvatarRegistry,valid_avatar_id
 
 import argparse
 import random
@@ -51,7 +52,7 @@ app = Flask(__name__)
 nerfreals:Dict[int, BaseReal] = {} #sessionid:BaseReal
 opt = None
 model = None
-avatar = None
+avatars = None #AvatarRegistry, avatar_id:avatar shared by all sessions
         
 
 #####webrtc###############################
@@ -63,8 +64,20 @@ def randN(N)->int:
     max = pow(10, N)
     return random.randint(min, max - 1)
 
-def build_nerfreal(sessionid:int)->BaseReal:
+def build_nerfreal(sessionid:int,avatar_id:str=None)->BaseReal:
     opt.sessionid=sessionid
+    if not avatar_id or opt.model == 'ernerf': #ernerf has one avatar per process
+        avatar_id = opt.avatar_id
+    avatar = avatars.acquire(avatar_id)
+    try:
+        nerfreal = create_nerfreal(avatar)
+    except Exception:
+        avatars.release(avatar_id)
+        raise
+    nerfreal.avatar_id = avatar_id
+    return nerfreal
+
+def create_nerfreal(avatar)->BaseReal:
     if opt.model == 'wav2lip':
         from lipreal import LipReal
         nerfreal = LipReal(opt,model,avatar)
@@ -79,6 +92,12 @@ def build_nerfreal(sessionid:int)->BaseReal:
         nerfreal = LightReal(opt,model,avatar)
     return nerfreal
 
+def close_nerfreal(sessionid):
+    nerfreal = nerfreals.pop(sessionid, None)
+    if nerfreal is not None:
+        nerfreal.release_assets()
+        avatars.release(nerfreal.avatar_id)
+
 #@app.route('/offer', methods=['POST'])
 async def offer(request):
     params = await request.json()
@@ -90,10 +109,25 @@ async def offer(request):
         
     params = await request.json()
     sessionid = params["sessionid"]
+    avatar_id = params.get("avatar_id")
+    if avatar_id and not valid_avatar_id(avatar_id):
+        logger.warning(f'offer with unknown avatar_id {avatar_id!r}')
+        return web.Response(status=400, content_type="application/json",
+                            text=json.dumps({"code": -1, "msg": "unknown avatar_id"}))
     logger.info(f"offer sessionid")
     logger.info(sessionid)
     nerfreals[sessionid] = None
-    nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid)
+    try:
+        nerfreal = await asyncio.get_event_loop().run_in_executor(None, build_nerfreal,sessionid,avatar_id)
+    except Exception:
+        logger.exception(f'load avatar {avatar_id} failed')
+        del nerfreals[sessionid]
+        return web.Response(
+            content_type="application/json",
+            text=json.dumps(
+                {"code": -1, "msg":f"load avatar {avatar_id} failed"}
+            ),
+        )
     nerfreals[sessionid] = nerfreal
     
     pc = RTCPeerConnection()
@@ -105,10 +139,10 @@ async def offer(request):
         if pc.connectionState == "failed":
             await pc.close()
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_nerfreal(sessionid)
         if pc.connectionState == "closed":
             pcs.discard(pc)
-            del nerfreals[sessionid]
+            close_nerfreal(sessionid)
 
     player = HumanPlayer(nerfreals[sessionid])
     audio_sender = pc.addTrack(player.audio)
@@ -427,6 +461,10 @@ if __name__ == '__main__':
     parser.add_argument('--avatar_id', type=str, default='avator_1')
     parser.add_argument('--bbox_shift', type=int, default=5)
     parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--adaptive_batch', action='store_true', help="wav2lip/musetalk/ultralight: start speech with 1 frame batches and grow to batch_size, lowers response latency")
+    parser.add_argument('--max_avatar_mem', type=int, default=0, help="MB of idle avatars kept loaded for /offer avatar_id, 0 means no limit")
+    parser.add_argument('--fixed_point_blend', action='store_true', help="musetalk: keep blend masks as uint8 alpha, 1/4 of the memory, +-1 pixel error")
+    parser.add_argument('--imgcache_size', type=int, default=0, help="wav2lip/ultralight: keep at most this many decoded full_imgs in memory, 0 loads them all")
 
     # parser.add_argument('--customvideo', action='store_true', help="custom video")
     # parser.add_argument('--customvideo_img', type=str, default='data/customvideo/img')
@@ -447,6 +485,22 @@ if __name__ == '__main__':
     parser.add_argument('--push_url', type=str, default='http://localhost:1985/rtc/v1/whip/?app=live&stream=livestream') #rtmp://localhost/live/livestream
 
     parser.add_argument('--max_session', type=int, default=1)  #multi session count
+    parser.add_argument('--infer_backend', type=str, default='torch', choices=['torch','torchscript','onnx'], help="wav2lip/ultralight: model runtime, exported models are cached next to the checkpoint")
+    parser.add_argument('--infer_threads', type=int, default=0, help="cpu threads of torch/onnxruntime, 0 means library default")
+    parser.add_argument('--quantize', type=str, default='none', choices=['none','int8','bf16'], help="cpu inference: int8/bf16 lip-sync model and audio encoder, checked against float. --infer_backend is not used then")
+    parser.add_argument('--quantize_calib', type=str, default='', help="wav to calibrate --quantize with, default a synthetic voiced signal")
+    parser.add_argument('--infer_process', action='store_true', help="wav2lip: run the inference of all sessions in one worker process with one model, frames and features through shared memory. not combined with --slo")
+    parser.add_argument('--lookahead', type=int, default=0, help="feature prefetch: video frames of a complete tts sentence/uploaded audio to extract audio features for in one pass, rendering still runs in batches of batch_size. 0 is off")
+    parser.add_argument('--whisper_window', type=float, default=0, help="musetalk: seconds of audio the whisper encoder runs on per asr step instead of 30s, must cover (l+2*batch_size+r)*0.02s. 0 is off")
+    parser.add_argument('--hubert_context', type=int, default=0, help="ultralight: encode only the new audio of an asr step, the hubert transformer sees this many 20ms frames of context around it, below (l+r)/2 to reuse any. 0 encodes the whole window")
+    parser.add_argument('--decimate', type=int, default=1, help="wav2lip/musetalk/ultralight: run the lip model on every n-th frame only, the mouths in between are blended from the neighbouring predictions")
+    parser.add_argument('--no_pipeline', action='store_true', help="wav2lip/musetalk/ultralight: run prepare/forward/post of a batch one after another instead of overlapping them")
+    parser.add_argument('--slo', action='store_true', help="wav2lip/musetalk/ultralight: under overload step down to every other frame inference, then idle frames")
+    parser.add_argument('--slo_fps', type=float, default=25, help="video fps the slo controller has to keep")
+    parser.add_argument('--batch_server', action='store_true', help="wav2lip/musetalk/ultralight: merge the inference batches of all sessions into one forward pass")
+    parser.add_argument('--batch_server_wait', type=float, default=10, help="ms the oldest batch may wait for other sessions")
+    parser.add_argument('--asr_batch_server', action='store_true', help="musetalk/ultralight/ernerf: merge the audio feature windows of all sessions into one whisper/hubert/wav2vec forward pass, waits --batch_server_wait")
+    parser.add_argument('--batch_server_max', type=int, default=0, help="max frames per merged forward pass, 0 means no limit")
     parser.add_argument('--listenport', type=int, default=8010)
 
     # 对话引擎
@@ -463,11 +517,13 @@ if __name__ == '__main__':
     if opt.customvideo_config!='':
         with open(opt.customvideo_config,'r') as file:
             opt.customopt = json.load(file)
+    if opt.infer_process and opt.model != 'wav2lip':
+        parser.error('--infer_process is only implemented for --model wav2lip')
 
     if opt.model == 'ernerf':       
         from nerfreal import NeRFReal,load_model,load_avatar
         model = load_model(opt)
-        avatar = load_avatar(opt) 
+        avatars = AvatarRegistry(lambda avatar_id: load_avatar(opt),opt.max_avatar_mem*2**20)
         
         # we still need test_loader to provide audio features for testing.
         # for k in range(opt.max_session):
@@ -478,29 +534,50 @@ if __name__ == '__main__':
         from musereal import MuseReal,load_model,load_avatar,warm_up
         logger.info(opt)
         model = load_model()
-        avatar = load_avatar(opt.avatar_id) 
+        if opt.quantize != 'none': #only the whisper encoder, unet/vae run fp16 on the gpu
+            from quantize import quantize_audio_encoder,calib_speech
+            calib_wav = calib_speech(opt.quantize_calib)
+            quantize_audio_encoder(model[4],lambda: model[4].audio2feat(calib_wav),opt.quantize,'whisper')
+        if opt.whisper_window > 0: #checked against the 30s window on speech, stays off if the features differ
+            from quantize import calib_speech
+            model[4].set_window(opt.whisper_window,calib_speech(opt.quantize_calib),(opt.l+2*opt.batch_size+opt.r)*320)
+        avatars = AvatarRegistry(lambda avatar_id: load_avatar(avatar_id,opt.fixed_point_blend),opt.max_avatar_mem*2**20)
         warm_up(opt.batch_size,model)      
         # for k in range(opt.max_session):
         #     opt.sessionid=k
         #     nerfreal = MuseReal(opt,audio_processor,vae, unet, pe,timesteps)
         #     nerfreals.append(nerfreal)
     elif opt.model == 'wav2lip':
-        from lipreal import LipReal,load_model,load_avatar,warm_up
+        from lipreal import LipReal,load_model,load_avatar,warm_up,quantize_model
         logger.info(f"wav2lip ops is: {opt}")
-        model = load_model("./models/wav2lip.pth")
-        avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size,model,256)
+        avatars = AvatarRegistry(lambda avatar_id: load_avatar(avatar_id,opt.imgcache_size,not opt.infer_process),opt.max_avatar_mem*2**20)
+        if opt.infer_process: #the worker process loads, quantizes and warms up the model and holds the face tensors
+            model = None
+        else:
+            model = load_model("./models/wav2lip.pth",opt.infer_backend if opt.quantize=='none' else 'torch',opt.infer_threads,opt.batch_size)
+            if opt.quantize != 'none': #calibrated on the default avatar
+                model = quantize_model(model,avatars.acquire(opt.avatar_id)[3],opt.quantize,opt.quantize_calib)
+                avatars.release(opt.avatar_id)
+            warm_up(opt.batch_size,model,256)
         # for k in range(opt.max_session):
         #     opt.sessionid=k
         #     nerfreal = LipReal(opt,model)
         #     nerfreals.append(nerfreal)
     elif opt.model == 'ultralight':
-        from lightreal import LightReal,load_model,load_avatar,warm_up
+        from lightreal import LightReal,load_model,load_avatar,warm_up,calib_audio_feats
         logger.info(opt)
         model = load_model(opt)
-        avatar = load_avatar(opt.avatar_id)
-        warm_up(opt.batch_size,avatar,160)
-
+        calib_feats = calib_audio_feats(model,opt.quantize,opt.quantize_calib)
+        if opt.hubert_context > 0: #checked against the whole window on speech, stays off if the features differ
+            from quantize import calib_speech
+            model.set_context(opt.hubert_context,calib_speech(opt.quantize_calib),(opt.l+2*opt.batch_size+opt.r)*320,2*opt.batch_size*320)
+        avatars = AvatarRegistry(lambda avatar_id: load_avatar(avatar_id,opt.imgcache_size,opt.infer_backend,opt.infer_threads,opt.batch_size,
+                                                               opt.quantize,calib_feats),
+                                 opt.max_avatar_mem*2**20)
+        warm_up(opt.batch_size,avatars.acquire(opt.avatar_id),160)
+
+    if opt.model != 'ultralight':
+        avatars.acquire(opt.avatar_id) #default avatar stays loaded
     if opt.transport=='rtmp':
         thread_quit = Event()
         nerfreals[0] = build_nerfreal(0)
@@ -0,0 +1,124 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import os
+from collections import OrderedDict
+from threading import Lock, Condition
+
+import numpy as np
+import torch
+
+from logger import logger
+from inferserver import release_batch_server
+
+def avatar_nbytes(obj):
+    """approximate memory held by a loaded avatar (tuple of frames, coords, tensors, models)"""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    if isinstance(obj, torch.nn.Module):
+        return sum(p.element_size() * p.nelement() for p in obj.parameters())
+    if isinstance(obj, (list, tuple)):
+        return sum(avatar_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(avatar_nbytes(o) for o in obj.values())
+    return getattr(obj, 'nbytes', 0) #PackedImages, ImgCache (its full capacity)
+
+def close_avatar(obj):
+    """stop what an evicted avatar runs in the background (ImgCache prefetch, batch server of its model) and free its caches"""
+    if isinstance(obj, (list, tuple)):
+        for o in obj:
+            close_avatar(o)
+    elif isinstance(obj, dict):
+        for o in obj.values():
+            close_avatar(o)
+    elif not isinstance(obj, (np.ndarray, torch.Tensor)):
+        release_batch_server(obj) #model of the avatar (ultralight), its server holds it
+        if not isinstance(obj, torch.nn.Module) and callable(getattr(obj, 'close', None)):
+            obj.close()
+
+def valid_avatar_id(avatar_id, root='./data/avatars'):
+    """avatar_id names a folder directly in root, no path separators or .. from the client"""
+    return (isinstance(avatar_id, str) and avatar_id not in ('', '.', '..')
+            and os.path.basename(avatar_id) == avatar_id and '\\' not in avatar_id
+            and os.path.isdir(os.path.join(root, avatar_id)))
+
+class AvatarRegistry:
+    """
+    Loads avatars on first use and shares them between sessions.
+    acquire/release keep a reference count per avatar_id; avatars nobody uses
+    are kept for reuse and evicted least recently used first once the loaded
+    avatars exceed max_bytes (0 means no limit). Avatars in use are never evicted.
+    """
+    def __init__(self, loader, max_bytes=0):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.avatars = OrderedDict() #avatar_id: [avatar, refs]
+        self.loading = set()
+        self.lock = Lock()
+        self.loaded = Condition(self.lock)
+
+    def acquire(self, avatar_id):
+        with self.lock:
+            while avatar_id in self.loading: #another session is loading the same avatar
+                self.loaded.wait()
+            entry = self.avatars.get(avatar_id)
+            if entry is not None:
+                entry[1] += 1
+                self.avatars.move_to_end(avatar_id)
+                return entry[0]
+            self.loading.add(avatar_id)
+        try:
+            logger.info(f'load avatar {avatar_id}')
+            avatar = self.loader(avatar_id)
+            nbytes = avatar_nbytes(avatar)
+        except:
+            with self.lock:
+                self.loading.discard(avatar_id)
+                self.loaded.notify_all()
+            raise
+        with self.lock: #published before the waiting sessions wake up, they take a reference on it
+            self.avatars[avatar_id] = [avatar, 1]
+            self.loading.discard(avatar_id)
+            self.loaded.notify_all()
+            logger.info(f'avatar {avatar_id} loaded, {nbytes/2**20:.1f}MB, total {self.nbytes()/2**20:.1f}MB')
+            self.__evict()
+        return avatar
+
+    def release(self, avatar_id):
+        with self.lock:
+            entry = self.avatars.get(avatar_id)
+            if entry is None:
+                return
+            entry[1] = max(entry[1]-1, 0)
+            self.__evict()
+
+    def nbytes(self):
+        # measured every time, members may change size after they were loaded
+        return sum(avatar_nbytes(entry[0]) for entry in self.avatars.values())
+
+    def __evict(self):
+        if self.max_bytes <= 0:
+            return
+        for avatar_id in list(self.avatars):
+            if self.nbytes() <= self.max_bytes:
+                break
+            if self.avatars[avatar_id][1] == 0:
+                avatar = self.avatars.pop(avatar_id)[0]
+                close_avatar(avatar)
+                logger.info(f'evict avatar {avatar_id}, total {self.nbytes()/2**20:.1f}MB')
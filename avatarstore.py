@@ -0,0 +1,446 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# packed avatar image store
+# an image folder (full_imgs, face_imgs, mask ...) is packed into one contiguous
+# uint8 file plus an index, and opened with np.memmap. all sessions and all
+# spawned worker processes then share the same page cache instead of decoding
+# the png files again.
+#   <img_path>.bin        raw uint8 pixels of all images, back to back
+#   <img_path>_index.npy  int64 [N,4]: offset,h,w,c of every image
+#
+# avatar bundle
+# a whole avatar (images, coords, mask coords, latents, avator_info.json) in one
+# versioned file that is loaded with a single mmap:
+#   16 bytes header: magic, format version, manifest length
+#   manifest json: info + name,offset,dtype,shape,sha256 of every section
+#   sections, each aligned to SECTION_ALIGN bytes
+# image sets are stored as two sections, <name> (pixels) and <name>.index.
+# convert existing avatars with: python avatarstore.py data/avatars/<avatar_id>
+
+import os
+import glob
+import json
+import struct
+import hashlib
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+
+from tqdm import tqdm
+from logger import logger
+
+def list_imgs(img_path):
+    input_img_list = glob.glob(os.path.join(img_path, '*.[jpJP][pnPN]*[gG]'))
+    return sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+
+def _workers(workers):
+    return workers or min(16, os.cpu_count() or 1)
+
+def iter_imgs(img_list, workers=None):
+    """
+    decode img_list on a thread pool (cv2 releases the GIL) and yield the frames in order.
+    at most 2*workers decoded frames are held ahead of the consumer
+    """
+    workers = _workers(workers)
+    with ThreadPoolExecutor(workers) as pool:
+        pending = []
+        for img_path in img_list:
+            pending.append(pool.submit(cv2.imread, img_path))
+            if len(pending) >= 2*workers:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+def read_imgs(img_list, out=None, workers=None):
+    """
+    decode img_list in parallel with a progress bar.
+    returns a list of frames, or fills and returns out if a preallocated
+    (N,H,W,3) uint8 array is given (all images must have that size)
+    """
+    logger.info('reading images...')
+    if out is None:
+        return list(tqdm(iter_imgs(img_list, workers), total=len(img_list)))
+    if len(out) != len(img_list):
+        raise ValueError(f'out has room for {len(out)} images, got {len(img_list)}')
+    def read_into(i):
+        frame = cv2.imread(img_list[i])
+        if frame is None:
+            raise IOError(f'failed to read {img_list[i]}')
+        out[i] = frame
+    with ThreadPoolExecutor(_workers(workers)) as pool:
+        list(tqdm(pool.map(read_into, range(len(img_list))), total=len(img_list)))
+    return out
+
+def read_imgs_array(img_list, workers=None):
+    """
+    decode img_list into one preallocated (N,H,W,3) array sized by the first image,
+    one allocation instead of N. falls back to a list when the sizes differ
+    """
+    if len(img_list) == 0:
+        return []
+    first = cv2.imread(img_list[0])
+    if first is None:
+        raise IOError(f'failed to read {img_list[0]}')
+    try:
+        return read_imgs(img_list, np.empty((len(img_list),)+first.shape, dtype=np.uint8), workers)
+    except ValueError: #could not broadcast, the images have different sizes
+        logger.warning(f'images of {os.path.dirname(img_list[0])} have different sizes, read as a list')
+        return read_imgs(img_list, workers=workers)
+
+def frames_array(frames):
+    """[N,h,w,c] array of a frame list when it has one without copying (ndarray, uniform PackedImages), else None"""
+    if isinstance(frames, np.ndarray):
+        return frames
+    if isinstance(frames, PackedImages) and frames.uniform:
+        return frames.as_array()
+    return None
+
+def pack_paths(img_path):
+    img_path = img_path.rstrip('/\\')
+    return f"{img_path}.bin", f"{img_path}_index.npy"
+
+class PackedImages:
+    """
+    Read-only, list-like view over images packed into one contiguous uint8 buffer.
+    packed[idx] returns a (h,w,c) ndarray view without copying or decoding.
+    source tells a spawned process how to map the same file again:
+    ('pack',data_path,index_path) or ('bundle',bundle_path,name).
+    """
+    def __init__(self, data, index, source=None):
+        self.data = data
+        self.index = index
+        self.source = source
+        shapes = index[:, 1:]
+        self.uniform = len(index)>0 and bool((shapes==shapes[0]).all())
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        offset,h,w,c = self.index[idx]
+        return np.asarray(self.data[offset:offset+h*w*c]).reshape(h,w,c)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def as_array(self):
+        """[N,h,w,c] view of the whole set, only when all images have the same shape"""
+        if not self.uniform:
+            raise ValueError('packed images have different shapes')
+        _,h,w,c = self.index[0]
+        return np.asarray(self.data[:len(self)*h*w*c]).reshape(len(self),h,w,c)
+
+    @property
+    def nbytes(self):
+        return int(self.data.shape[0])
+
+    # spawned processes reopen the mapping instead of receiving a pickled copy
+    def __getstate__(self):
+        if self.source is None:
+            return self.__dict__
+        return {'source':self.source}
+
+    def __setstate__(self, state):
+        if 'data' in state:
+            self.__dict__.update(state)
+            return
+        kind, path, name = state['source']
+        if kind == 'bundle':
+            packed = AvatarBundle(path).images(name)
+        else:
+            packed = open_packed(path, name)
+        self.__dict__.update(packed.__dict__)
+
+def open_packed(data_path, index_path):
+    if not (os.path.isfile(data_path) and os.path.isfile(index_path)):
+        return None
+    index = np.load(index_path)
+    if os.path.getsize(data_path)==0:
+        data = np.zeros(0, dtype=np.uint8)
+    else:
+        data = np.memmap(data_path, dtype=np.uint8, mode='r')
+    return PackedImages(data, index, ('pack', data_path, index_path))
+
+def pack_images(img_list, data_path, index_path):
+    """decode img_list once and write the packed files, one image in memory at a time"""
+    logger.info(f'packing {len(img_list)} images into {data_path}...')
+    index = np.zeros((len(img_list),4), dtype=np.int64)
+    offset = 0
+    tmp_data_path = data_path + '.tmp'
+    try:
+        with open(tmp_data_path, 'wb') as f:
+            for i,frame in enumerate(tqdm(iter_imgs(img_list), total=len(img_list))):
+                if frame is None:
+                    raise IOError(f'failed to read {img_list[i]}')
+                if frame.ndim == 2:
+                    frame = frame[:,:,np.newaxis]
+                index[i] = (offset,) + frame.shape
+                f.write(np.ascontiguousarray(frame).data)
+                offset += frame.size
+    except BaseException:
+        os.remove(tmp_data_path)
+        raise
+    tmp_index_path = index_path + '.tmp.npy'
+    np.save(tmp_index_path, index)
+    # rename last so that concurrent readers never see a half written pack
+    os.replace(tmp_data_path, data_path)
+    os.replace(tmp_index_path, index_path)
+
+def is_stale(img_path, img_list, data_path, index_path, packed):
+    if packed is None or len(packed)!=len(img_list):
+        return True
+    if len(img_list)==0:
+        return False
+    newest = max(os.path.getmtime(img_path), max(os.path.getmtime(p) for p in img_list))
+    return newest > os.path.getmtime(index_path)
+
+def load_images(img_path):
+    """
+    return the images of img_path as a memory-mapped PackedImages,
+    packing the folder first if there is no up-to-date pack yet
+    """
+    data_path, index_path = pack_paths(img_path)
+    img_list = list_imgs(img_path)
+    packed = open_packed(data_path, index_path)
+    if len(img_list)==0 and packed is not None: #pack shipped without the png folder
+        return packed
+    if is_stale(img_path, img_list, data_path, index_path, packed):
+        pack_images(img_list, data_path, index_path)
+        packed = open_packed(data_path, index_path)
+    logger.info(f'load packed images {data_path}: {len(packed)} frames, {packed.nbytes/2**20:.1f}MB mapped')
+    return packed
+
+def bundle_images(img_path, tmp_dir):
+    """
+    the images of img_path for write_bundle. an up-to-date pack next to the folder is used,
+    otherwise they are packed into tmp_dir so that converting leaves no pack files behind
+    """
+    data_path, index_path = pack_paths(img_path)
+    img_list = list_imgs(img_path)
+    packed = open_packed(data_path, index_path)
+    if (len(img_list)==0 and packed is not None) or not is_stale(img_path, img_list, data_path, index_path, packed):
+        return packed
+    data_path, index_path = pack_paths(os.path.join(tmp_dir, os.path.basename(img_path.rstrip('/\\'))))
+    pack_images(img_list, data_path, index_path)
+    return open_packed(data_path, index_path)
+
+###############################################################################
+BUNDLE_MAGIC = b'LTAVATAR'
+BUNDLE_VERSION = 1
+BUNDLE_NAME = 'avatar.bundle'
+SECTION_ALIGN = 4096
+
+def bundle_path(avatar_path):
+    return os.path.join(avatar_path, BUNDLE_NAME)
+
+def custom_bundle_path(item):
+    """bundle of a customvideo_config entry, next to its image folder unless given explicitly"""
+    return item.get('bundle', item['imgpath'].rstrip('/\\') + '.bundle')
+
+class AvatarBundle:
+    def __init__(self, path, preload=False):
+        """
+        preload=False maps the file, preload=True reads it with one sequential read
+        (for network filesystems where page faults are slow)
+        """
+        self.path = path
+        if preload:
+            with open(path, 'rb') as f:
+                self.buf = np.frombuffer(f.read(), dtype=np.uint8)
+        else:
+            self.buf = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, manifest_len = struct.unpack('<8sII', bytes(self.buf[:16]))
+        if magic != BUNDLE_MAGIC:
+            raise ValueError(f'{path} is not an avatar bundle')
+        if version > BUNDLE_VERSION:
+            raise ValueError(f'{path}: bundle version {version} is newer than supported {BUNDLE_VERSION}')
+        self.version = version
+        self.manifest = json.loads(bytes(self.buf[16:16+manifest_len]).decode('utf-8'))
+        self.sections = self.manifest['sections']
+
+    @property
+    def info(self):
+        return self.manifest.get('info', {})
+
+    def has(self, name):
+        return name in self.sections
+
+    def array(self, name):
+        sec = self.sections[name]
+        raw = np.asarray(self.buf[sec['offset']:sec['offset']+sec['nbytes']])
+        return raw.view(np.dtype(sec['dtype'])).reshape(sec['shape'])
+
+    def images(self, name):
+        return PackedImages(self.array(name), self.array(name+'.index'), ('bundle', self.path, name))
+
+    def coords(self, name):
+        return [tuple(c) for c in self.array(name).tolist()]
+
+    def verify(self):
+        bad = []
+        for name,sec in self.sections.items():
+            raw = np.asarray(self.buf[sec['offset']:sec['offset']+sec['nbytes']])
+            if hashlib.sha256(raw).hexdigest() != sec['sha256']:
+                bad.append(name)
+        return bad
+
+def open_bundle(path):
+    if not os.path.isfile(path):
+        return None
+    bundle = AvatarBundle(path)
+    logger.info(f'load avatar bundle {path}: v{bundle.version}, sections {list(bundle.sections)}')
+    return bundle
+
+def write_bundle(path, sections, info=None):
+    """
+    sections: dict name -> ndarray, or PackedImages (stored as name and name.index)
+    the section data is written to a temp file first, then header+manifest are written
+    in front of it so that the manifest comes first in the final file
+    """
+    arrays = {}
+    for name,value in sections.items():
+        if isinstance(value, PackedImages):
+            arrays[name] = np.asarray(value.data)
+            arrays[name+'.index'] = value.index
+        else:
+            arrays[name] = np.ascontiguousarray(value)
+
+    manifest = {'format':'livetalking-avatar', 'version':BUNDLE_VERSION,
+                'info':info or {}, 'sections':{}}
+    offset = 0
+    with tempfile.TemporaryFile() as body:
+        for name,arr in arrays.items():
+            pad = -offset % SECTION_ALIGN
+            body.write(b'\0'*pad)
+            offset += pad
+            raw = arr.reshape(-1).view(np.uint8)
+            digest = hashlib.sha256()
+            for start in range(0, raw.nbytes, 16*2**20): #no copy of a whole section in memory
+                chunk = raw[start:start+16*2**20].data
+                body.write(chunk)
+                digest.update(chunk)
+            manifest['sections'][name] = {'offset':offset, 'nbytes':raw.nbytes, 'dtype':arr.dtype.str,
+                                          'shape':list(arr.shape), 'sha256':digest.hexdigest()}
+            offset += raw.nbytes
+        # section offsets become absolute once the header length is known,
+        # which itself depends on the digits of the offsets
+        body_offsets = {name:sec['offset'] for name,sec in manifest['sections'].items()}
+        head_len = 0
+        while True:
+            for name,sec in manifest['sections'].items():
+                sec['offset'] = head_len + body_offsets[name]
+            manifest_bytes = json.dumps(manifest, ensure_ascii=False, default=_json_default).encode('utf-8')
+            need = 16 + len(manifest_bytes)
+            if need <= head_len:
+                break
+            head_len = need + (-need % SECTION_ALIGN)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack('<8sII', BUNDLE_MAGIC, BUNDLE_VERSION, len(manifest_bytes)))
+            f.write(manifest_bytes)
+            f.write(b'\0'*(head_len-16-len(manifest_bytes)))
+            body.seek(0)
+            shutil.copyfileobj(body, f, 16*2**20)
+        os.replace(tmp_path, path)
+    logger.info(f'write avatar bundle {path}: {head_len+offset} bytes, sections {list(arrays)}')
+
+def _json_default(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError(f'{type(o)} is not json serializable')
+
+def convert_avatar(avatar_path):
+    """pack data/avatars/<avatar_id> (wav2lip, musetalk or ultralight layout) into avatar.bundle"""
+    import pickle
+    info = {'avatar_id':os.path.basename(avatar_path.rstrip('/\\'))}
+    info_path = os.path.join(avatar_path, 'avator_info.json')
+    if os.path.isfile(info_path):
+        with open(info_path, 'r') as f:
+            info.update(json.load(f))
+    with tempfile.TemporaryDirectory(dir=avatar_path) as tmp_dir:
+        sections = {}
+        for name in ['full_imgs','face_imgs','mask']:
+            img_path = os.path.join(avatar_path, name)
+            if os.path.isdir(img_path):
+                sections[name] = bundle_images(img_path, tmp_dir)
+        for name in ['coords','mask_coords']:
+            coords_path = os.path.join(avatar_path, f'{name}.pkl')
+            if os.path.isfile(coords_path):
+                with open(coords_path, 'rb') as f:
+                    sections[name] = np.asarray(pickle.load(f), dtype=np.int32).reshape(-1,4)
+        latents_path = os.path.join(avatar_path, 'latents.pt')
+        if os.path.isfile(latents_path):
+            import torch
+            latents = torch.load(latents_path, map_location='cpu')
+            sections['latents'] = torch.cat(latents, dim=0).numpy()  #[N,8,32,32]
+        write_bundle(bundle_path(avatar_path), sections, info)
+        sections.clear() #unmap the temporary packs before their folder goes
+
+def convert_custom(item):
+    """pack one customvideo_config entry (image folder + wav) into its bundle"""
+    import soundfile as sf
+    audio, sample_rate = sf.read(item['audiopath'], dtype='float32')
+    info = {'audiotype':item['audiotype'], 'sample_rate':sample_rate}
+    path = custom_bundle_path(item)
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp_dir:
+        sections = {'imgs':bundle_images(item['imgpath'], tmp_dir), 'audio':audio}
+        write_bundle(path, sections, info)
+        sections.clear() #unmap the temporary pack before its folder goes
+
+def convert_images(img_path):
+    """pack a plain image folder (e.g. --fullbody_img) into <img_path>.bundle"""
+    path = img_path.rstrip('/\\') + '.bundle'
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as tmp_dir:
+        sections = {'imgs':bundle_images(img_path, tmp_dir)}
+        write_bundle(path, sections)
+        sections.clear() #unmap the temporary pack before its folder goes
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='convert avatars into single file bundles')
+    parser.add_argument('avatars', nargs='*', help="avatar folders, default all of data/avatars/*")
+    parser.add_argument('--custom_config', type=str, default='', help="also convert the custom videos of this customvideo_config")
+    parser.add_argument('--images', type=str, nargs='*', default=[], help="plain image folders to convert, e.g. the fullbody_img folder")
+    parser.add_argument('--verify', action='store_true', help="only check the checksums of existing bundles")
+    args = parser.parse_args()
+
+    avatars = args.avatars
+    if not avatars and not args.custom_config and not args.images:
+        avatars = sorted(p for p in glob.glob('data/avatars/*') if os.path.isdir(p))
+    custom_items = []
+    if args.custom_config:
+        with open(args.custom_config, 'r') as f:
+            custom_items = json.load(f)
+
+    if args.verify:
+        paths = [bundle_path(p) for p in avatars] + [custom_bundle_path(item) for item in custom_items] \
+                + [p.rstrip('/\\')+'.bundle' for p in args.images]
+        for path in paths:
+            bad = AvatarBundle(path).verify()
+            print(f'{path}: ' + ('ok' if not bad else f'checksum mismatch in {bad}'))
+    else:
+        for avatar_path in avatars:
+            convert_avatar(avatar_path)
+        for item in custom_items:
+            convert_custom(item)
+        for img_path in args.images:
+            convert_images(img_path)
@@ -20,10 +20,14 @@ import numpy as np
 
 import queue
 from queue import Queue
+from threading import Lock
 import torch.multiprocessing as mp
 
 from basereal import BaseReal
 
+# feature of a silent video frame by (asr class, stride_left_size, stride_right_size), shared by all sessions
+_silence_chunks = {}
+_silence_lock = Lock()
 
 class BaseASR:
     def __init__(self, opt, parent:BaseReal = None):
@@ -37,8 +41,21 @@ class BaseASR:
         self.output_queue = mp.Queue()
 
         self.batch_size = opt.batch_size
+        # --adaptive_batch: start speech with 1 frame batches and double them while inference keeps up
+        self.adaptive_batch = getattr(opt, 'adaptive_batch', False)
+        self.curr_batch_size = 1 if self.adaptive_batch else self.batch_size
+        self.was_speaking = False
+        self.step_time = 0 #wall time of the last run_step, blocked by feat_queue when inference lags
+        # --lookahead, feature prefetch: queued chunks of utterances whose audio is complete (tts sentence,
+        # uploaded file) are extracted in one pass of up to lookahead video frames instead of batch by batch.
+        # only the audio feature extraction is ahead, the lip-sync model renders batch_size frames at a time
+        self.lookahead = getattr(opt, 'lookahead', 0)
+        self.known_chunks = 0
+        self.known_lock = Lock()
 
         self.frames = []
+        self.frame_types = [] #audio type of every chunk in self.frames
+        self.frames_start = 0 #position of self.frames[0] in the session's chunk stream
         self.stride_left_size = opt.l
         self.stride_right_size = opt.r
         #self.context_size = 10
@@ -47,16 +64,27 @@ class BaseASR:
         #self.warm_up()
 
     def flush_talk(self):
-        self.queue.queue.clear()
+        with self.known_lock:
+            self.queue.queue.clear()
+            self.known_chunks = 0
 
     def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms pcm
-        self.queue.put((audio_chunk,eventpoint))
+        self.queue.put((audio_chunk,eventpoint,False))
+
+    def put_audio_utterance(self,frames): #[(audio_chunk,eventpoint)], all 16khz 20ms pcm of one utterance
+        with self.known_lock:
+            for audio_chunk,eventpoint in frames:
+                self.queue.put((audio_chunk,eventpoint,True))
+            self.known_chunks += len(frames)
 
     #return frame:audio pcm; type: 0-normal speak, 1-silence; eventpoint:custom event sync with audio
     def get_audio_frame(self):        
         try:
-            frame,eventpoint = self.queue.get(block=True,timeout=0.01)
+            frame,eventpoint,known = self.queue.get(block=True,timeout=0.01)
             type = 0
+            if known: #only chunks of put_audio_utterance are counted
+                with self.known_lock:
+                    self.known_chunks = max(self.known_chunks-1, 0)
             #print(f'[INFO] get frame {frame.shape}')
         except queue.Empty:
             if self.parent and self.parent.curr_state>1: #播放自定义音频
@@ -77,11 +105,119 @@ class BaseASR:
         for _ in range(self.stride_left_size + self.stride_right_size):
             audio_frame,type,eventpoint=self.get_audio_frame()
             self.frames.append(audio_frame)
+            self.frame_types.append(type)
             self.output_queue.put((audio_frame,type,eventpoint))
         for _ in range(self.stride_left_size):
             self.output_queue.get()
 
+    def next_batch_size(self):
+        if not self.adaptive_batch:
+            return self.batch_size
+        speaking = not self.queue.empty()
+        if not speaking:
+            self.curr_batch_size = 1
+        elif self.was_speaking and self.curr_batch_size < self.batch_size and self.step_time < self.curr_batch_size*2/self.fps:
+            # the last batch was extracted and taken by inference faster than its audio plays
+            self.curr_batch_size = min(self.curr_batch_size*2, self.batch_size)
+        self.was_speaking = speaking
+        return self.curr_batch_size
+
+    def lookahead_size(self):
+        """video frames of known audio to extract at once, a multiple of batch_size, 0 if less than 2 batches"""
+        if self.lookahead <= 0:
+            return 0
+        with self.known_lock:
+            chunks = min(self.known_chunks, self.queue.qsize())
+        frames = min(chunks//2, self.lookahead) // self.batch_size * self.batch_size
+        return frames if frames >= 2*self.batch_size else 0
+
     def run_step(self):
+        ############################################## extract audio feature ##############################################
+        # get batch_size video frames of audio, 2 chunks each
+        t = time.perf_counter()
+        batch_size = self.next_batch_size()
+        lookahead = self.lookahead_size()
+        if lookahead > 0:
+            batch_size = lookahead
+        for _ in range(batch_size*2):
+            frame,type,eventpoint = self.get_audio_frame()
+            self.frames.append(frame)
+            self.frame_types.append(type)
+            # put to output
+            self.output_queue.put((frame,type,eventpoint))
+        # context not enough, do not run network.
+        if len(self.frames) <= self.stride_left_size + self.stride_right_size:
+            return
+
+        # the chunks of this batch follow the left context. inference only runs the model when one of
+        # them is speech, silence and custom audio show the avatar frames, so skip the extraction then
+        batch_types = self.frame_types[self.stride_left_size:self.stride_left_size+batch_size*2]
+        if all(type != 0 for type in batch_types):
+            chunks = self.silence_chunks(batch_size)
+        else:
+            # frames without speech in their audio context get the cached silence feature
+            silent = self.silent_frames(batch_size)
+            inputs = np.concatenate(self.frames) # [N * chunk]
+            chunks = self.extract_chunks(inputs,batch_size,self.frames_start*self.chunk,silent)
+            if silent:
+                chunk = self.silence_chunk()
+                for i in silent:
+                    chunks[i] = chunk
+        if lookahead > 0: #one extraction for the lookahead, the model still gets batches of batch_size
+            for start in range(0, batch_size, self.batch_size):
+                self.feat_queue.put(chunks[start:start+self.batch_size])
+        else:
+            self.feat_queue.put(chunks)
+        self.step_time = time.perf_counter() - t
+        # discard the old part to save memory
+        if self.stride_left_size + self.stride_right_size > 0:
+            self.frames_start += max(len(self.frames) - (self.stride_left_size + self.stride_right_size), 0)
+        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+        self.frame_types = self.frame_types[-(self.stride_left_size + self.stride_right_size):]
+
+    def silence_chunk(self):
+        """feature of a silent video frame, extracted once from zeros"""
+        key = (type(self), self.stride_left_size, self.stride_right_size)
+        chunk = _silence_chunks.get(key)
+        if chunk is None:
+            n = self.stride_left_size + 2*self.batch_size + self.stride_right_size
+            chunk = self.extract_chunks(np.zeros(n*self.chunk, dtype=np.float32), 1)[0]
+            with _silence_lock:
+                chunk = _silence_chunks.setdefault(key, chunk)
+        return chunk
+
+    def silence_chunks(self,batch_size):
+        return [self.silence_chunk()]*batch_size
+
+    def silent_frames(self,batch_size):
+        """frames of the batch with no speech chunk in their frame_span"""
+        n = len(self.frame_types)
+        speech = np.concatenate(([0], np.cumsum(np.array(self.frame_types) == 0)))
+        silent = []
+        for i in range(batch_size):
+            lo,hi = self.frame_span(i)
+            lo,hi = max(lo,0),min(hi,n)
+            if speech[hi] == speech[lo]:
+                silent.append(i)
+        return silent
+
+    def frame_span(self,i):
+        """chunks of the window that the feature of video frame i of the batch depends on"""
+        return 0,len(self.frame_types)
+
+    def extract_chunks(self,inputs,batch_size,start=None,silent=()):
+        """
+        model audio input of batch_size video frames.
+        inputs holds stride_left_size context chunks, batch_size*2 new chunks and stride_right_size lookahead chunks.
+        start is the sample position of inputs in the session's audio, None when inputs is not part of it.
+        the frames in silent get the silence feature afterwards and need not be extracted
+        """
+        feature = self.audio_feature(inputs,start)
+        return self.audio_processor.feature2chunks(feature_array=feature,fps=self.fps/2,batch_size=batch_size,
+                                                   audio_feat_length=self.audio_feat_length,start=self.stride_left_size/2)
+
+    def audio_feature(self,inputs,start=None):
+        """audio feature of inputs at 50 per second, for asr classes that use the extract_chunks above"""
         pass
 
     def get_next_feat(self,block,timeout):        
@@ -22,13 +22,12 @@ import numpy as np
 import subprocess
 import os
 import time
-import cv2
 import glob
 import resampy
 
 import queue
 from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Lock, Condition
 from io import BytesIO
 import soundfile as sf
 
@@ -37,15 +36,76 @@ from fractions import Fraction
 
 from ttsreal import EdgeTTS,VoitsTTS,XTTS,CosyVoiceTTS,FishTTS,TencentTTS,KokoroTTS
 from logger import logger
+from avatarstore import open_bundle,custom_bundle_path,read_imgs_array
+from slo import create_slo
 
-from tqdm import tqdm
-def read_imgs(img_list):
-    frames = []
-    logger.info('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
+# custom videos are shared by all sessions of the process, keyed by imgpath+audiopath.
+# each session only keeps its own custom_index/custom_audio_index
+_custom_assets = {}
+_custom_lock = Lock()
+_custom_loading = set() #keys being loaded, outside the lock
+_custom_loaded = Condition(_custom_lock)
+
+def _custom_key(item):
+    return (os.path.abspath(item['imgpath']), os.path.abspath(item['audiopath']))
+
+def _load_custom(item):
+    bundle = open_bundle(custom_bundle_path(item))
+    if bundle is not None:
+        return bundle.images('imgs'), bundle.array('audio')
+    input_img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
+    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
+    imgs = read_imgs_array(input_img_list)
+    if isinstance(imgs, np.ndarray):
+        imgs.setflags(write=False)
+    else:
+        for img in imgs:
+            img.setflags(write=False)
+    audio, sample_rate = sf.read(item['audiopath'], dtype='float32')
+    audio.setflags(write=False)
+    return imgs, audio
+
+def acquire_custom(item):
+    """return the (read-only) images and audio of a custom video, loading it on first use"""
+    key = _custom_key(item)
+    with _custom_lock:
+        while key in _custom_loading: #another session is loading the same video
+            _custom_loaded.wait()
+        asset = _custom_assets.get(key)
+        if asset is not None:
+            asset['refs'] += 1
+            return asset['imgs'], asset['audio']
+        _custom_loading.add(key)
+    try: #decode without the lock, other sessions start meanwhile
+        imgs, audio = _load_custom(item)
+    except:
+        with _custom_lock:
+            _custom_loading.discard(key)
+            _custom_loaded.notify_all()
+        raise
+    with _custom_lock: #published before the waiting sessions wake up, they take a reference on it
+        _custom_assets[key] = {'imgs':imgs, 'audio':audio, 'refs':1}
+        _custom_loading.discard(key)
+        _custom_loaded.notify_all()
+    return imgs, audio
+
+def release_custom(item):
+    key = _custom_key(item)
+    with _custom_lock:
+        asset = _custom_assets.get(key)
+        if asset is None:
+            return
+        asset['refs'] -= 1
+        if asset['refs'] <= 0:
+            del _custom_assets[key]
+            logger.info(f"release custom video {item['imgpath']}")
+
+def mirror_indices(size, start, n):
+    """mirror_index of start..start+n-1 as one int64 array"""
+    index = np.arange(start, start+n)
+    turn = index // size
+    res = index % size
+    return np.where(turn % 2 == 0, res, size - res - 1)
 
 class BaseReal:
     def __init__(self, opt):
@@ -86,21 +146,37 @@ class BaseReal:
         self.custom_opt = {}
         self.__loadcustom()
 
+        self.slo = create_slo(opt) #None unless --slo
+
+    def release_assets(self):
+        """drop this session's references to the shared custom videos, called when the session closes"""
+        for item in getattr(self, 'custom_opt', {}).values():
+            release_custom(item)
+        self.custom_opt = {}
+
+    def __del__(self): #fallback, the session may never be collected (asr.parent, threads)
+        self.release_assets()
+
     def put_msg_txt(self,msg,eventpoint=None):
         self.tts.put_msg_txt(msg,eventpoint)
     
     def put_audio_frame(self,audio_chunk,eventpoint=None): #16khz 20ms pcm
         self.asr.put_audio_frame(audio_chunk,eventpoint)
 
+    def put_audio_utterance(self,frames): #[(audio_chunk,eventpoint)], the complete audio of one utterance
+        self.asr.put_audio_utterance(frames)
+
     def put_audio_file(self,filebyte): 
         input_stream = BytesIO(filebyte)
         stream = self.__create_bytes_stream(input_stream)
         streamlen = stream.shape[0]
         idx=0
+        frames = []
         while streamlen >= self.chunk:  #and self.state==State.RUNNING
-            self.put_audio_frame(stream[idx:idx+self.chunk])
+            frames.append((stream[idx:idx+self.chunk],None))
             streamlen -= self.chunk
             idx += self.chunk
+        self.put_audio_utterance(frames)
     
     def __create_bytes_stream(self,byte_stream):
         #byte_stream=BytesIO(buffer)
@@ -128,10 +204,7 @@ class BaseReal:
     def __loadcustom(self):
         for item in self.opt.customopt:
             logger.info(item)
-            input_img_list = glob.glob(os.path.join(item['imgpath'], '*.[jpJP][pnPN]*[gG]'))
-            input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-            self.custom_img_cycle[item['audiotype']] = read_imgs(input_img_list)
-            self.custom_audio_cycle[item['audiotype']], sample_rate = sf.read(item['audiopath'], dtype='float32')
+            self.custom_img_cycle[item['audiotype']], self.custom_audio_cycle[item['audiotype']] = acquire_custom(item)
             self.custom_audio_index[item['audiotype']] = 0
             self.custom_index[item['audiotype']] = 0
             self.custom_opt[item['audiotype']] = item
@@ -2,6 +2,9 @@ import time
 import torch
 import numpy as np
 from baseasr import BaseASR
+from functools import partial
+from ultralight.audio2feature import HubertStream,hubert_hidden_state,encoder_hidden_state
+from inferserver import get_batch_server
 
 # hubert audio feature
 class HubertASR(BaseASR):
@@ -12,25 +15,24 @@ class HubertASR(BaseASR):
         #self.stride_left_size = 32
         #self.stride_right_size = 32
         self.audio_feat_length = audio_feat_length
+        self.forward = None
+        encoder = None
+        if getattr(opt,'asr_batch_server',False): #one hubert forward for the windows of all sessions
+            self.forward = get_batch_server(audio_processor.model,partial(hubert_hidden_state,audio_processor),0,
+                                            opt.batch_server_wait/1000,'hubert')
+            encoder = get_batch_server(audio_processor.model.encoder,partial(encoder_hidden_state,audio_processor),0,
+                                       opt.batch_server_wait/1000,'hubert encoder')
+        self.hubert_stream = HubertStream(audio_processor,encoder) #with --hubert_context only new audio is encoded
 
 
-    def run_step(self):
-        start_time = time.time()
-        
-        for _ in range(self.batch_size * 2):
-            audio_frame, type,eventpoint = self.get_audio_frame()
-            self.frames.append(audio_frame)
-            self.output_queue.put((audio_frame, type,eventpoint))
-        
-        if len(self.frames) <= self.stride_left_size + self.stride_right_size:
-            return
-        
-        inputs = np.concatenate(self.frames)  # [N * chunk]
+    def frame_span(self, i):
+        # hubert frames of the feature slice, 25ms windows every 20ms. the transformer attends to the
+        # whole window, so speech outside of the span only changes the feature slightly
+        center = self.stride_left_size + 2*i
+        return center-16, center+18
 
-        mel = self.audio_processor.get_hubert_from_16k_speech(inputs)
-        mel_chunks=self.audio_processor.feature2chunks(feature_array=mel,fps=self.fps/2,batch_size=self.batch_size,audio_feat_length = self.audio_feat_length, start=self.stride_left_size/2)
-
-        self.feat_queue.put(mel_chunks)
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
-        #print(f"Processing audio costs {(time.time() - start_time) * 1000}ms")
+    def audio_feature(self, inputs, start=None):
+        if self.audio_processor.context > 0 and start is not None:
+            return self.hubert_stream.features(inputs, start)
+        return self.audio_processor.get_hubert_from_16k_speech(inputs,self.forward)
 
@@ -0,0 +1,192 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import cv2
+import weakref
+from collections import OrderedDict
+from threading import Thread, Event, Lock
+
+from avatarstore import list_imgs, load_images
+from logger import logger
+
+class ImgCache:
+    """
+    Bounded LRU cache of decoded avatar frames, used in place of frame_list_cycle
+    for avatars too long to keep in memory. A background thread decodes the
+    next frames along the mirror_index ping-pong path ahead of playback.
+    The cache is shared by all sessions of the avatar, every session reads through
+    its own view() so that each one keeps its own playback cursor.
+    """
+    def __init__(self, total, img_path, capacity=1000, prefetch=25):
+        self.img_list = list_imgs(img_path)
+        if len(self.img_list) != total:
+            logger.warning(f'imgcache: {img_path} has {len(self.img_list)} images, expected {total}')
+        self.total = min(total, len(self.img_list))
+        if self.total == 0:
+            raise ValueError(f'imgcache: no images in {img_path}')
+        self.prefetch = min(prefetch, capacity//2)
+        self.capacity = capacity
+
+        self.cache = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+        self.evicted = 0
+        self.cursors = weakref.WeakKeyDictionary() #view: [cursor, direction]
+        self.wakeup = Event()
+        self.quit_event = Event()
+        self.frame_nbytes = self.__load(0).nbytes
+        Thread(target=self.__prefetch_loop, daemon=True).start()
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, idx):
+        return self.get_img(idx)
+
+    def view(self):
+        """frame list of one session, get_img through it moves that session's cursor only"""
+        view = ImgCacheView(self)
+        with self.lock:
+            self.cursors[view] = [0, 1]
+        return view
+
+    def get_img(self, idx, view=None):
+        with self.lock:
+            img = self.cache.get(idx)
+            if img is not None:
+                self.cache.move_to_end(idx)
+                self.hits += 1
+            else:
+                self.misses += 1
+            state = self.cursors.get(view) if view is not None else None
+            if state is not None:
+                if idx != state[0]:
+                    state[1] = 1 if idx > state[0] else -1
+                state[0] = idx
+            if (self.hits + self.misses) % 1000 == 0:
+                logger.info('imgcache stats:%s', self.stats())
+        if img is None:
+            img = self.__load(idx)
+        self.wakeup.set()
+        return img
+
+    @property
+    def nbytes(self):
+        """memory the cache may hold once it is full"""
+        return min(self.capacity, self.total) * self.frame_nbytes
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'size':len(self.cache), 'capacity':self.capacity,
+                'hits':self.hits, 'misses':self.misses,
+                'hit_rate':self.hits/total if total else 0.0,
+                'prefetched':self.prefetched, 'evicted':self.evicted,
+                'sessions':len(self.cursors)}
+
+    def close(self):
+        self.quit_event.set()
+        self.wakeup.set()
+        with self.lock:
+            self.cache.clear()
+
+    def __load(self, idx, prefetch=False):
+        img = cv2.imread(self.img_list[idx])
+        if img is None:
+            raise IOError(f'imgcache: failed to read {self.img_list[idx]}')
+        img.setflags(write=False) #shared by all sessions, copy before drawing on it
+        with self.lock:
+            if self.quit_event.is_set():
+                return img
+            if idx not in self.cache:
+                self.cache[idx] = img
+                if prefetch:
+                    self.prefetched += 1
+            self.cache.move_to_end(idx)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+                self.evicted += 1
+        return img
+
+    def trajectory(self, idx, direction, n):
+        """next n frame indices after idx on the ping-pong path, the end frames are shown twice"""
+        path = []
+        for _ in range(n):
+            nxt = idx + direction
+            if nxt < 0 or nxt >= self.total:
+                direction = -direction
+                nxt = idx
+            idx = nxt
+            path.append(idx)
+        return path
+
+    def __prefetch_loop(self):
+        failed = set()
+        while not self.quit_event.is_set():
+            self.wakeup.wait(1)
+            self.wakeup.clear()
+            with self.lock:
+                states = [tuple(state) for state in self.cursors.values()]
+            if not states:
+                continue
+            # the prefetch budget is split between the sessions, so they do not evict each other's frames
+            n = max(self.prefetch // len(states), 1)
+            paths = [self.trajectory(cursor, direction, n) for cursor, direction in states]
+            for step in range(n): #nearest frames of every session first
+                if self.quit_event.is_set() or self.wakeup.is_set(): #playback moved on, restart from new cursors
+                    break
+                for path in paths:
+                    idx = path[step]
+                    with self.lock:
+                        cached = idx in self.cache
+                    if cached or idx in failed:
+                        continue
+                    try:
+                        self.__load(idx, prefetch=True)
+                    except IOError as e:
+                        logger.error(str(e))
+                        failed.add(idx)
+
+class ImgCacheView:
+    """per session frame list over a shared ImgCache"""
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, idx):
+        return self.cache.get_img(idx, self)
+
+def load_frames(img_path, total, imgcache_size=0, bundle=None, name='full_imgs'):
+    """
+    full frames of an avatar: an ImgCache over the image folder with imgcache_size > 0,
+    else the memory-mapped bundle/pack. an avatar shipped only as a bundle or pack has
+    no image files to stream, it falls back to the mapped images
+    """
+    if imgcache_size > 0:
+        if list_imgs(img_path):
+            return ImgCache(total, img_path, imgcache_size)
+        logger.warning(f'{img_path} has no image files to stream with --imgcache_size, use the packed images')
+    if bundle is not None:
+        return bundle.images(name)
+    return load_images(img_path)
+
+def session_frames(frame_list_cycle):
+    """what a session indexes: its own view of an ImgCache, any other frame list as is"""
+    return frame_list_cycle.view() if isinstance(frame_list_cycle, ImgCache) else frame_list_cycle
@@ -0,0 +1,152 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# inference backends for the lip-sync models
+#   torch        eager pytorch (default)
+#   torchscript  torch.jit.trace, saved as <checkpoint>.<device>.ts
+#   onnx         exported to <checkpoint>.onnx, run with onnxruntime
+# the exported file is cached next to the checkpoint and exported again when the
+# checkpoint is newer. every backend is called like the torch model with tensors
+# and returns a tensor, so inference() does not change. if export or loading fails
+# (e.g. onnxruntime not installed) the eager model is used.
+
+import os
+import time
+
+import torch
+
+from logger import logger
+
+BACKENDS = ['torch', 'torchscript', 'onnx']
+
+def artifact_path(checkpoint, backend, device):
+    stem = os.path.splitext(checkpoint)[0]
+    if backend == 'torchscript': #traced graphs keep the device of the trace
+        return f'{stem}.{torch.device(device).type}.ts'
+    return f'{stem}.onnx'
+
+def _is_stale(path, checkpoint):
+    if not os.path.exists(path):
+        return True
+    return os.path.exists(checkpoint) and os.path.getmtime(checkpoint) > os.path.getmtime(path)
+
+class OrtModel:
+    """onnxruntime session with the call convention of the torch model"""
+    def __init__(self, path, device='cpu', threads=0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ['CPUExecutionProvider']
+        if str(device).startswith('cuda') and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = onnxruntime.InferenceSession(path, options, providers=providers)
+        self.input_names = [x.name for x in self.session.get_inputs()]
+        self.device = device
+
+    def __call__(self, *inputs):
+        feeds = {name: x.detach().float().cpu().numpy() for name, x in zip(self.input_names, inputs)}
+        out = self.session.run(None, feeds)[0]
+        return torch.from_numpy(out).to(self.device)
+
+    def eval(self):
+        return self
+
+def _export(model, example_inputs, path, backend):
+    with torch.no_grad():
+        if backend == 'torchscript':
+            traced = torch.jit.trace(model, example_inputs)
+            traced = torch.jit.freeze(traced.eval())
+            traced.save(path)
+        else:
+            names = [f'input{i}' for i in range(len(example_inputs))]
+            torch.onnx.export(model, example_inputs, path, input_names=names, output_names=['output'],
+                              dynamic_axes={name: {0: 'batch'} for name in names + ['output']},
+                              opset_version=11, export_params=True)
+
+def load_backend(model, example_inputs, checkpoint, backend='torch', device='cpu', threads=0, name='model'):
+    """
+    model: eager torch model in eval mode, example_inputs: tuple of tensors of one batch.
+    returns a callable taking/returning tensors, the eager model for backend torch or on failure
+    """
+    if threads > 0 and not str(device).startswith('cuda'):
+        torch.set_num_threads(threads)
+    if backend == 'torch':
+        return model
+    path = artifact_path(checkpoint, backend, device)
+    try:
+        if _is_stale(path, checkpoint):
+            logger.info(f'export {name} to {path}')
+            _export(model, example_inputs, path, backend)
+        if backend == 'torchscript':
+            runner = torch.jit.load(path, map_location=device)
+        else:
+            runner = OrtModel(path, device, threads)
+        with torch.no_grad(): #check the exported model once against eager
+            expect = model(*example_inputs)
+            got = runner(*example_inputs)
+        err = (expect.float() - got.float().to(expect.device)).abs().max().item()
+        if err > 1e-2:
+            raise RuntimeError(f'{backend} output differs from torch by {err}')
+        logger.info(f'{name} runs with {backend}, max diff to torch {err:.2e}')
+        return runner
+    except Exception:
+        logger.exception(f'{name} {backend} backend failed, fall back to torch')
+        return model
+
+if __name__ == '__main__':
+    # fps of every backend with random weights/inputs, e.g. on a gpu-less node:
+    # python inferbackend.py --model wav2lip --batch_size 16 --threads 8
+    import argparse
+    import tempfile
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default='wav2lip', choices=['wav2lip', 'ultralight'])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--iters', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.model == 'wav2lip':
+        from wav2lip.models import Wav2Lip
+        model = Wav2Lip()
+        inputs = (torch.rand(args.batch_size, 1, 80, 16), torch.rand(args.batch_size, 6, 256, 256))
+    else:
+        from ultralight.unet import Model, reparameterize_model
+        model = reparameterize_model(Model(6, 'hubert').eval())
+        inputs = (torch.rand(args.batch_size, 6, 160, 160), torch.rand(args.batch_size, 32, 32, 32))
+    model = model.to(args.device).eval()
+    inputs = tuple(x.to(args.device) for x in inputs)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        checkpoint = os.path.join(tmp, f'{args.model}.pth')
+        for backend in BACKENDS:
+            runner = load_backend(model, inputs, checkpoint, backend, args.device, args.threads, args.model)
+            if backend != 'torch' and runner is model:
+                print(f'{backend:12s} not available')
+                continue
+            with torch.no_grad():
+                runner(*inputs) #warm up
+                t = time.perf_counter()
+                for _ in range(args.iters):
+                    runner(*inputs)
+                if str(args.device).startswith('cuda'):
+                    torch.cuda.synchronize()
+                elapsed = time.perf_counter() - t
+            print(f'{backend:12s} {args.iters*args.batch_size/elapsed:8.1f} fps')
@@ -0,0 +1,201 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# three stage inference pipeline
+#   prepare  gather/copy the inputs of batch N+1 into a slot (caller thread)
+#   forward  run the model on batch N
+#   post     scale/transpose/uint8 of batch N-1 and push to res_frame_queue
+# each stage is one thread, stages hand over through queues of size 1, so the
+# order of batches never changes. slots are preallocated input/output buffers
+# that are reused, a slot is free again after post. silence batches carry no
+# slot and only pass through to keep their place in the order. a batch whose forward
+# or post fails goes out like a silence batch, so its audio is still played in order,
+# once: a failed post only pushes the frames it did not push yet as silence.
+# with threaded=False the same stages run one after another in the caller thread.
+
+import time
+from queue import Queue
+from threading import Thread
+
+import cv2
+import numpy as np
+import torch
+
+from logger import logger
+
+_STOP = object()
+
+class InferPipeline:
+    def __init__(self, prepare, forward, post, make_slot, num_slots=3, threaded=True, device='cpu', name='model', slo=None):
+        self.prepare = prepare #prepare(job,slot)
+        self.forward = forward #forward(job,slot)
+        self.post = post #post(job,slot), slot is None for silence jobs. sets job['emitted'] to the frames pushed so far
+        self.make_slot = make_slot
+        self.threaded = threaded
+        self.name = name
+        self.slo = slo
+
+        self.free_slots = Queue()
+        for _ in range(num_slots if threaded else 1):
+            self.free_slots.put(make_slot())
+        # inputs are copied on their own cuda stream, so the copy of N+1 overlaps the forward of N
+        self.copy_stream = torch.cuda.Stream() if threaded and str(device).startswith('cuda') else None
+
+        self.stage_time = [0.0, 0.0, 0.0]
+        self.frames = 0
+        self.model_frames = 0
+        self.batches = 0
+        if threaded:
+            self.forward_queue = Queue(1)
+            self.post_queue = Queue(1)
+            self.threads = [Thread(target=self.__forward_loop, daemon=True),
+                            Thread(target=self.__post_loop, daemon=True)]
+            for t in self.threads:
+                t.start()
+
+    def submit(self, job, silence=False):
+        """job is a dict with at least 'n', the number of frames"""
+        job['times'] = [0.0, 0.0, 0.0]
+        slot = None
+        if not silence:
+            slot = self.free_slots.get()
+            t = time.perf_counter()
+            if self.copy_stream is not None:
+                with torch.cuda.stream(self.copy_stream):
+                    self.prepare(job, slot)
+                slot['ready'] = torch.cuda.Event()
+                slot['ready'].record(self.copy_stream)
+            else:
+                self.prepare(job, slot)
+            job['times'][0] = time.perf_counter() - t
+        if self.threaded:
+            self.forward_queue.put((job, slot))
+        else:
+            self.__run_forward(job, slot)
+            self.__run_post(job, slot)
+
+    def close(self):
+        if self.threaded:
+            self.forward_queue.put(_STOP)
+            for t in self.threads:
+                t.join()
+
+    def stats(self):
+        """average ms per batch of each stage, the largest one is the bottleneck"""
+        n = max(self.batches, 1)
+        return {stage: self.stage_time[i]*1000/n for i,stage in enumerate(('prepare','forward','post'))}
+
+    def __run_forward(self, job, slot):
+        if slot is None:
+            return
+        t = time.perf_counter()
+        if slot.get('ready') is not None:
+            torch.cuda.current_stream().wait_event(slot['ready'])
+        try:
+            with torch.no_grad():
+                self.forward(job, slot)
+        except Exception:
+            logger.exception(f'{self.name} forward failed')
+            job['failed'] = True
+        job['times'][1] = time.perf_counter() - t
+
+    def __run_post(self, job, slot):
+        if slot is not None and job.get('failed'):
+            self.free_slots.put(slot)
+            slot = None
+        t = time.perf_counter()
+        try:
+            self.post(job, slot)
+        except Exception:
+            logger.exception(f'{self.name} post failed')
+            if slot is None:
+                return
+            self.free_slots.put(slot)
+            self.post(job, None) #no result frames, only the audio of the frames after job['emitted']
+            return
+        if slot is None:
+            return
+        job['times'][2] = time.perf_counter() - t
+        self.free_slots.put(slot)
+        self.__account(job)
+
+    def __forward_loop(self):
+        while True:
+            item = self.forward_queue.get()
+            if item is not _STOP:
+                self.__run_forward(*item)
+            self.post_queue.put(item)
+            if item is _STOP:
+                break
+
+    def __post_loop(self):
+        while True:
+            item = self.post_queue.get()
+            if item is _STOP:
+                break
+            try:
+                self.__run_post(*item)
+            except Exception:
+                logger.exception(f'{self.name} post failed')
+
+    def __account(self, job):
+        times = job['times']
+        # pipelined, a batch costs as much as its slowest stage, else the sum of all stages
+        batch_time = max(times) if self.threaded else sum(times)
+        if self.slo is not None:
+            self.slo.report_infer(job.get('model_frames', job['n']), batch_time)
+        for i in range(3):
+            self.stage_time[i] += times[i]
+        self.frames += job['n']
+        self.model_frames += job.get('model_frames', job['n'])
+        self.batches += 1
+        if self.frames >= 100:
+            total = max(self.stage_time) if self.threaded else sum(self.stage_time)
+            stats = self.stats()
+            logger.info(f"------actual avg infer fps:{self.frames/total:.4f}, per batch: prepare {stats['prepare']:.2f}ms "
+                        f"forward {stats['forward']:.2f}ms post {stats['post']:.2f}ms, "
+                        f"model ran on {self.model_frames/self.frames:.2f} of the frames")
+            self.stage_time = [0.0, 0.0, 0.0]
+            self.frames = 0
+            self.model_frames = 0
+            self.batches = 0
+
+def model_positions(n, step):
+    """frames of a batch of n that go through the model: every step-th and the last one"""
+    pos = np.arange(0, n, step)
+    if pos[-1] != n-1:
+        pos = np.append(pos, n-1)
+    return pos
+
+def interp_frames(res, pos, n):
+    """
+    the n mouth frames of a batch from the model outputs res (uint8, one per pos),
+    frames between two model frames are blended linearly. every frame is a new array
+    """
+    j = 0
+    for i in range(n):
+        if j+1 < len(pos) and i >= pos[j+1]:
+            j += 1
+        if i == pos[j]:
+            yield res[j].copy()
+        else:
+            w = (i - pos[j]) / (pos[j+1] - pos[j])
+            yield cv2.addWeighted(res[j], 1-w, res[j+1], w, 0)
+
+def pinned_empty(shape, dtype, device):
+    """host staging buffer, page-locked when copying to/from cuda"""
+    return torch.empty(shape, dtype=dtype, pin_memory=str(device).startswith('cuda'))
@@ -0,0 +1,308 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# out of process inference
+# the model runs in a spawned worker process shared by all sessions, so the model work
+# does not share the GIL with aiohttp, aiortc encoding and compositing, and there is
+# one copy of the model however many sessions run.
+#   main process   per session, feeder: feat_queue + audio frame types -> in ring
+#                  collector: out ring -> res_frame_queue, paired with the audio frames
+#   worker process setup() once, then per session a thread running inference() on the
+#                  rings of its channel through queue-like adapters
+# a channel is one in ring and one out ring, fixed size records in shared memory,
+# single producer / single consumer, synchronized by two semaphores. the channels are
+# created before the worker is spawned (semaphores are only shared by inheritance) and
+# reused by the next session. only the audio frame type crosses the process, the pcm
+# itself stays in the main process.
+
+import queue
+import atexit
+from collections import deque
+from threading import Thread, Lock
+from multiprocessing import shared_memory
+import multiprocessing
+
+import numpy as np
+
+from logger import logger
+
+class ShmRing:
+    """
+    slots records of (data: shape/dtype, header: int64[header]) in one shared memory block.
+    producer: write() -> (data,header) views, fill them, commit()
+    consumer: read() -> (data,header) views, copy out, release()
+    """
+    def __init__(self, slots, shape, dtype, header=1, ctx=None):
+        ctx = ctx or multiprocessing.get_context('spawn')
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.header = header
+        size = slots*(int(np.prod(self.shape))*self.dtype.itemsize + header*8)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size,1))
+        self.owner = True
+        self.free = ctx.Semaphore(slots)
+        self.filled = ctx.Semaphore(0)
+        self.pos = 0
+        self.__map()
+
+    def __map(self):
+        self.data = np.ndarray((self.slots,)+self.shape, self.dtype, buffer=self.shm.buf)
+        self.headers = np.ndarray((self.slots,self.header), np.int64, buffer=self.shm.buf,
+                                  offset=self.data.nbytes)
+
+    def __getstate__(self): #passed to the worker as a Process argument
+        return (self.shm.name, self.slots, self.shape, self.dtype, self.header, self.free, self.filled)
+
+    def __setstate__(self, state):
+        name, self.slots, self.shape, self.dtype, self.header, self.free, self.filled = state
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = False
+        self.pos = 0
+        self.__map()
+
+    def write(self, timeout=None):
+        """views of the next free record, None on timeout"""
+        if not self.free.acquire(timeout=timeout):
+            return None
+        i = self.pos % self.slots
+        return self.data[i], self.headers[i]
+
+    def commit(self):
+        self.pos += 1
+        self.filled.release()
+
+    def read(self, timeout=None):
+        """views of the oldest filled record, None on timeout"""
+        if not self.filled.acquire(timeout=timeout):
+            return None
+        i = self.pos % self.slots
+        return self.data[i], self.headers[i]
+
+    def release(self):
+        self.pos += 1
+        self.free.release()
+
+    def drain(self):
+        """free every filled record and start over at record 0, once neither side uses the ring"""
+        while self.filled.acquire(timeout=0):
+            self.free.release()
+        self.pos = 0
+
+    def close(self):
+        del self.data, self.headers #views must go before the buffer
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class _FeatQueue:
+    """worker side audio_feat_queue, one in ring record is one batch"""
+    def __init__(self, ring, types):
+        self.ring = ring
+        self.types = types
+
+    def get(self, block=True, timeout=None):
+        record = self.ring.read(timeout if block else 0)
+        if record is None:
+            raise queue.Empty
+        data, header = record
+        n = int(header[0])
+        feats = data[:n].copy()
+        self.types.extend((None,int(t),None) for t in header[1:1+2*n])
+        self.ring.release()
+        return feats
+
+class _AudioQueue:
+    """worker side audio_out_queue, (None,type,None) per audio frame of the batch just read"""
+    def __init__(self, types):
+        self.types = types
+
+    def get(self, block=True, timeout=None):
+        return self.types.popleft()
+
+class _FrameQueue:
+    """worker side res_frame_queue, one out ring record per video frame"""
+    def __init__(self, ring, stop_event):
+        self.ring = ring
+        self.stop_event = stop_event
+
+    def put(self, item, block=True, timeout=None):
+        res_frame, idx, _ = item
+        record = None
+        while record is None:
+            if self.stop_event.is_set():
+                return
+            record = self.ring.write(timeout=1)
+        data, header = record
+        if res_frame is not None:
+            data[...] = res_frame
+        header[0] = res_frame is not None
+        header[1] = idx
+        self.ring.commit()
+
+class _Channel:
+    """rings and events of one session slot of the worker"""
+    def __init__(self, ctx, batch_size, feat_shape, feat_dtype, frame_shape):
+        self.batch_size = batch_size
+        self.in_ring = ShmRing(3, (batch_size,)+tuple(feat_shape), feat_dtype, 1+2*batch_size, ctx)
+        self.out_ring = ShmRing(4*batch_size, frame_shape, np.uint8, 2, ctx)
+        self.stop_event = ctx.Event() #main -> worker: the session ends
+        self.done = ctx.Event() #worker -> main: the session thread is gone, the rings are unused
+
+def _serve(target, context, channel, args):
+    types = deque()
+    try:
+        target(channel.stop_event, channel.batch_size, _FeatQueue(channel.in_ring,types), _AudioQueue(types),
+               _FrameQueue(channel.out_ring,channel.stop_event), context, *args)
+    except Exception:
+        logger.exception('inference worker session failed')
+    finally:
+        channel.done.set()
+
+def _worker_main(setup, setup_args, target, channels, control):
+    context = setup(*setup_args)
+    while True:
+        item = control.get()
+        if item is None:
+            break
+        i, args = item
+        channel = channels[i]
+        channel.in_ring.pos = channel.out_ring.pos = 0 #drained by the main process
+        Thread(target=_serve, args=(target, context, channel, args), daemon=True).start()
+
+class InferProcess:
+    """
+    a spawned worker with one model for up to max_sessions sessions.
+    setup(*setup_args) runs once in the worker and returns the context (model) of the sessions.
+    target(quit_event,batch_size,audio_feat_queue,audio_out_queue,res_frame_queue,context,*args)
+    runs in the worker for each session.
+    feat_shape/dtype: one item of an audio_feat_queue batch
+    frame_shape: one res_frame, uint8
+    """
+    def __init__(self, setup, setup_args, target, max_sessions, batch_size, feat_shape, feat_dtype, frame_shape, name='model'):
+        ctx = multiprocessing.get_context('spawn') #cuda can not be used in a forked process
+        self.name = name
+        self.channels = [_Channel(ctx, batch_size, feat_shape, feat_dtype, frame_shape) for _ in range(max_sessions)]
+        self.free_channels = queue.Queue()
+        for i in range(max_sessions):
+            self.free_channels.put(i)
+        self.control = ctx.Queue()
+        self.process = ctx.Process(target=_worker_main, daemon=True,
+                                   args=(setup, setup_args, target, self.channels, self.control))
+        self.process.start()
+        logger.info(f'{name} inference process {self.process.pid} started, {max_sessions} sessions')
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        self.control.put(None)
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        for channel in self.channels:
+            channel.in_ring.close()
+            channel.out_ring.close()
+
+    def run(self, quit_event, audio_feat_queue, audio_out_queue, res_frame_queue, *args):
+        """one session with the same queues as inference(), returns after quit_event is set"""
+        try:
+            i = self.free_channels.get_nowait()
+        except queue.Empty:
+            logger.error(f'{self.name} inference process has no free session')
+            return
+        channel = self.channels[i]
+        channel.stop_event.clear()
+        channel.done.clear()
+        pending = deque() #audio frames of every frame sent to the worker, in order
+        self.control.put((i, args))
+        feeder = Thread(target=self.__feed, args=(quit_event,channel,pending,audio_feat_queue,audio_out_queue), daemon=True)
+        feeder.start()
+        try:
+            self.__collect(quit_event, channel, pending, res_frame_queue)
+        finally:
+            channel.stop_event.set()
+            feeder.join()
+            if channel.done.wait(5):
+                channel.in_ring.drain()
+                channel.out_ring.drain()
+                self.free_channels.put(i)
+            else: #the worker is stuck or gone, the rings may still be used
+                logger.error(f'{self.name} inference process did not end session {i}')
+            logger.info(f'{self.name} inference session {i} stop')
+
+    def __feed(self, quit_event, channel, pending, audio_feat_queue, audio_out_queue):
+        def stopped():
+            return quit_event.is_set() or channel.stop_event.is_set()
+        while not stopped():
+            try:
+                feats = audio_feat_queue.get(block=True, timeout=1)
+            except queue.Empty:
+                continue
+            n = len(feats)
+            audio_frames = []
+            while len(audio_frames) < n*2:
+                if stopped():
+                    return
+                try:
+                    audio_frames.append(audio_out_queue.get(block=True, timeout=1))
+                except queue.Empty:
+                    continue
+            record = None
+            while record is None:
+                if stopped():
+                    return
+                record = channel.in_ring.write(timeout=1)
+            data, header = record
+            np.stack(feats, out=data[:n])
+            header[0] = n
+            header[1:1+2*n] = [frame[1] for frame in audio_frames]
+            for i in range(n):
+                pending.append(audio_frames[i*2:i*2+2])
+            channel.in_ring.commit()
+
+    def __collect(self, quit_event, channel, pending, res_frame_queue):
+        while not quit_event.is_set():
+            record = channel.out_ring.read(timeout=1)
+            if record is None:
+                if not self.process.is_alive():
+                    logger.error(f'{self.name} inference process exited with {self.process.exitcode}')
+                    return
+                continue
+            data, header = record
+            res_frame = data.copy() if header[0] else None
+            idx = int(header[1])
+            channel.out_ring.release()
+            item = (res_frame, idx, pending.popleft())
+            while not quit_event.is_set(): #the consumer may be gone, e.g. the peer disconnected
+                try:
+                    res_frame_queue.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+
+_processes = {}
+_processes_lock = Lock()
+
+def get_infer_process(key, *args, **kwargs):
+    """the InferProcess(*args) of key shared by the sessions, started again if it died"""
+    with _processes_lock:
+        worker = _processes.get(key)
+        if worker is None or not worker.is_alive():
+            worker = _processes[key] = InferProcess(*args, **kwargs)
+            atexit.register(worker.close)
+        return worker
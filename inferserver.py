@@ -0,0 +1,165 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# cross-session batching
+# every session keeps its own inference thread and res_frame_queue, but instead of
+# calling the shared model it submits its batch here and waits for the result.
+# one worker thread per model merges the pending batches of all sessions into one
+# forward pass, so the result order of each session is unchanged.
+
+import time
+import queue
+import weakref
+from concurrent.futures import Future
+from threading import Thread, Lock
+
+import numpy as np
+import torch
+
+from logger import logger
+
+_STOP = object()
+
+class BatchServer:
+    """
+    forward(*inputs) is called with the inputs of several requests concatenated on dim 0.
+    requests are merged only when all their inputs have the same shape[1:] and dtype.
+    a batch is run as soon as it holds max_batch rows or the oldest request
+    waited max_wait seconds, whichever is first.
+    """
+    def __init__(self, forward, max_batch=0, max_wait=0.01, name='model'):
+        self.forward = forward
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self.requests = queue.Queue()
+        self.pending = []
+        self.count = 0
+        self.merged = 0
+        self.thread = Thread(target=self.__loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, *inputs):
+        """queue one batch, returns a Future of forward's output for these rows"""
+        future = Future()
+        self.requests.put((time.perf_counter(), inputs, future))
+        return future
+
+    def __call__(self, *inputs):
+        return self.submit(*inputs).result()
+
+    def close(self):
+        """run what is pending and stop the worker thread"""
+        self.requests.put(_STOP)
+        self.thread.join()
+
+    @staticmethod
+    def __key(inputs):
+        return tuple((tuple(x.shape[1:]), str(x.dtype)) for x in inputs)
+
+    def __loop(self):
+        stop = False
+        while not stop or self.pending:
+            if not self.pending:
+                req = self.requests.get()
+                if req is _STOP:
+                    break
+                self.pending.append(req)
+            deadline = self.pending[0][0] + self.max_wait
+            while not stop: #collect until the oldest request has to go
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0 or (self.max_batch and self.__rows(self.pending[0]) >= self.max_batch):
+                    break
+                try:
+                    req = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if req is _STOP:
+                    stop = True
+                else:
+                    self.pending.append(req)
+            self.__run()
+        logger.info(f'batch server {self.name} stop')
+
+    def __rows(self, first):
+        key = self.__key(first[1])
+        return sum(len(req[1][0]) for req in self.pending if self.__key(req[1]) == key)
+
+    def __run(self):
+        # oldest request decides which shape group runs now, the rest stay pending
+        key = self.__key(self.pending[0][1])
+        batch, rest, rows = [], [], 0
+        for req in self.pending:
+            n = len(req[1][0])
+            if self.__key(req[1]) == key and (not batch or not self.max_batch or rows + n <= self.max_batch):
+                batch.append(req)
+                rows += n
+            else:
+                rest.append(req)
+        self.pending = rest
+
+        try:
+            inputs = [self.__cat([req[1][i] for req in batch]) for i in range(len(batch[0][1]))]
+            with torch.no_grad():
+                output = self.forward(*inputs)
+        except Exception as e:
+            logger.exception(f'batch server {self.name} forward failed')
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for _, req_inputs, future in batch:
+            n = len(req_inputs[0])
+            future.set_result(output[start:start+n])
+            start += n
+
+        self.count += 1
+        self.merged += len(batch)
+        if self.count % 100 == 0:
+            logger.info(f'batch server {self.name}: {self.merged/self.count:.2f} requests per forward')
+            self.count = self.merged = 0
+
+    @staticmethod
+    def __cat(xs):
+        if len(xs) == 1:
+            return xs[0]
+        if isinstance(xs[0], torch.Tensor):
+            return torch.cat(xs, dim=0)
+        return np.concatenate(xs, axis=0)
+
+_servers = weakref.WeakKeyDictionary() #model: BatchServer
+_servers_lock = Lock()
+
+def get_batch_server(model, forward, max_batch=0, max_wait=0.01, name='model'):
+    """the BatchServer of a shared model instance, created on first use"""
+    with _servers_lock:
+        server = _servers.get(model)
+        if server is None:
+            server = _servers[model] = BatchServer(forward, max_batch, max_wait, name)
+            logger.info(f'start batch server for {name}, max_batch={max_batch} max_wait={max_wait*1000:.0f}ms')
+        return server
+
+def release_batch_server(model):
+    """stop the BatchServer of a model that is unloaded, its forward holds the model"""
+    with _servers_lock:
+        try:
+            server = _servers.pop(model, None)
+        except TypeError: #not weak referenceable, so never a model of a server
+            return
+    if server is not None:
+        server.close()
@@ -20,10 +20,8 @@ import torch
 import numpy as np
 
 #from .utils import *
-import os
 import time
 import cv2
-import glob
 import pickle
 import copy
 
@@ -36,15 +34,17 @@ import torch.multiprocessing as mp
 from hubertasr import HubertASR
 import asyncio
 from av import AudioFrame, VideoFrame
-from basereal import BaseReal
+from basereal import BaseReal,mirror_indices
+from slo import NORMAL,REUSE,IDLE
+from inferpipe import InferPipeline,pinned_empty,model_positions,interp_frames
+from inferserver import get_batch_server
+from inferbackend import load_backend
+from quantize import quantize_lipsync,quantize_audio_encoder,calib_speech,calib_rows
+from avatarstore import load_images,open_bundle,bundle_path,frames_array
 
-#from imgcache import ImgCache
-
-from tqdm import tqdm
+from imgcache import load_frames,session_frames
 
 #new
-import os
-import cv2
 import torch
 import numpy as np
 import torch.nn as nn
@@ -52,7 +52,7 @@ from torch import optim
 from tqdm import tqdm
 from transformers import Wav2Vec2Processor, HubertModel
 from torch.utils.data import DataLoader
-from ultralight.unet import Model
+from ultralight.unet import Model,reparameterize_model
 from ultralight.audio2feature import Audio2Feature
 from logger import logger
 
@@ -65,7 +65,7 @@ def load_model(opt):
     audio_processor = Audio2Feature()
     return audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,imgcache_size=0,backend='torch',threads=0,batch_size=1,quantize='none',calib_feats=None):
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
     face_imgs_path = f"{avatar_path}/face_imgs" 
@@ -73,36 +73,79 @@ def load_avatar(avatar_id):
     
     model = Model(6, 'hubert').to(device)  # 假设Model是你自定义的类
     model.load_state_dict(torch.load(f"{avatar_path}/ultralight.pth"))
+    model = reparameterize_model(model.eval()) #single branch blocks for inference, before quantize/export
     
-    with open(coords_path, 'rb') as f:
-        coord_list_cycle = pickle.load(f)
-    input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
-    #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
-    input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    face_list_cycle = read_imgs(input_face_list)
-
-    return model.eval(),frame_list_cycle,face_list_cycle,coord_list_cycle
+    bundle = open_bundle(bundle_path(avatar_path))
+    if bundle is not None:
+        coord_list_cycle = bundle.coords('coords')
+        face_list_cycle = bundle.images('face_imgs')
+    else:
+        with open(coords_path, 'rb') as f:
+            coord_list_cycle = pickle.load(f)
+        face_list_cycle = load_images(face_imgs_path)
+    #with imgcache_size full_imgs are streamed from disk with a bounded memory budget
+    frame_list_cycle = load_frames(full_imgs_path,len(coord_list_cycle),imgcache_size,bundle)
+
+    face_tensor = prepare_face_tensor(face_list_cycle)
+    if quantize != 'none': #calibrated on this avatar's faces, not combined with the export backends
+        model = quantize_model(model,face_tensor,calib_feats,quantize)
+    else:
+        example = (torch.ones(batch_size, 6, 160, 160).to(device), torch.ones(batch_size, 32, 32, 32).to(device))
+        model = load_backend(model, example, f"{avatar_path}/ultralight.pth", backend, device, threads, 'ultralight')
+    return model,frame_list_cycle,face_list_cycle,coord_list_cycle,face_tensor
+
+def prepare_face_tensor(face_list_cycle, dtype=None, chunk=64):
+    """
+    model image input of every avatar frame, [N,6,160,160] on device:
+    the [4:164,4:164] crop, then the same crop with the mouth rectangle
+    (5,5,150,145) blacked out, scaled to 0..1. fp16 on cuda, fp32 on cpu
+    """
+    if dtype is None:
+        dtype = torch.float16 if device == 'cuda' else torch.float32
+    length = len(face_list_cycle)
+    face_tensor = torch.empty((length,6,160,160), dtype=dtype, device=device)
+    face_array = frames_array(face_list_cycle) #packed faces are sliced without a python list
+    for start in range(0, length, chunk):
+        if face_array is not None:
+            faces = np.array(face_array[start:start+chunk, 4:164, 4:164])
+        else:
+            faces = np.asarray([face_list_cycle[i][4:164, 4:164] for i in range(start, min(start+chunk, length))])
+        faces = torch.from_numpy(faces).to(device).permute(0,3,1,2).float().div(255.).to(dtype)
+        end = start + len(faces)
+        face_tensor[start:end, :3] = faces
+        face_tensor[start:end, 3:] = faces
+        face_tensor[start:end, 3:, 5:150, 5:155] = 0 #same pixels as cv2.rectangle(img,(5,5,150,145),(0,0,0),-1)
+    return face_tensor
+
+
+def calib_audio_feats(audio_processor,mode,calib_wav=None,n=32):
+    """--quantize: quantizes the hubert encoder, returns n hubert windows of the calibration speech for the unet"""
+    if mode == 'none':
+        return None
+    wav = calib_speech(calib_wav)
+    quantize_audio_encoder(audio_processor, lambda: audio_processor.get_hubert_from_16k_speech(wav), mode, 'hubert')
+    feats = audio_processor.get_hubert_from_16k_speech(wav)
+    return audio_processor.feature2chunks(feature_array=feats,fps=25,batch_size=n,audio_feat_length=[8,8])
 
+@torch.no_grad()
+def quantize_model(model,face_tensor,calib_feats,mode,batch_size=8):
+    rows = calib_rows(len(face_tensor), len(calib_feats))
+    calib = []
+    for start in range(0, len(rows), batch_size):
+        idx = rows[start:start+batch_size]
+        feat_batch = torch.from_numpy(np.stack([np.asarray(f).reshape(32,32,32) for f in calib_feats[start:start+len(idx)]])).float()
+        img_batch = face_tensor[torch.from_numpy(idx).to(face_tensor.device)].float().cpu()
+        calib.append((img_batch, feat_batch))
+    return quantize_lipsync(model, calib, mode, 'ultralight')
 
 @torch.no_grad()
 def warm_up(batch_size,avatar,modelres):
     logger.info('warmup model...')
-    model,_,_,_ = avatar
+    model = avatar[0]
     img_batch = torch.ones(batch_size, 6, modelres, modelres).to(device)
     mel_batch = torch.ones(batch_size, 32, 32, 32).to(device)
     model(img_batch, mel_batch)
 
-def read_imgs(img_list):
-    frames = []
-    logger.info('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
-
 def get_audio_features(features, index):
     left = index - 8
     right = index + 8
@@ -147,80 +190,83 @@ def __mirror_index(size, index):
         return size - res - 1 
 
 
-def inference(quit_event, batch_size, face_list_cycle, audio_feat_queue, audio_out_queue, res_frame_queue, model):
-    length = len(face_list_cycle)
+def inference(quit_event, batch_size, face_tensor, audio_feat_queue, audio_out_queue, res_frame_queue, model, server=None, slo=None, pipelined=True, decimate=1):
+    length = face_tensor.shape[0]
+
+    # 预分配的输入输出缓冲区，流水线各阶段循环复用
+    def make_slot():
+        slot = {'idx': pinned_empty((batch_size,), torch.int64, device),
+                'idx_dev': torch.empty((batch_size,), dtype=torch.int64, device=device),
+                'img': torch.empty((batch_size, 6, 160, 160), dtype=torch.float32, device=device),
+                'mel_host': pinned_empty((batch_size, 32*32*32), torch.float32, device),
+                'mel': torch.empty((batch_size, 32, 32, 32), dtype=torch.float32, device=device),
+                'res_host': pinned_empty((batch_size, 160, 160, 3), torch.uint8, device)}
+        slot['gather'] = slot['img'] if face_tensor.dtype == torch.float32 else torch.empty((batch_size, 6, 160, 160), dtype=face_tensor.dtype, device=device)
+        return slot
+
+    def prepare(job, slot):
+        m = job['model_frames']
+        slot['idx'].numpy()[:m] = mirror_indices(length, job['index'], job['n'])[job['pos']]
+        idx = slot['idx_dev'][:m]
+        idx.copy_(slot['idx'][:m], non_blocking=True)
+        torch.index_select(face_tensor, 0, idx, out=slot['gather'][:m])
+        if slot['gather'] is not slot['img']:
+            slot['img'][:m].copy_(slot['gather'][:m])
+        np.stack([job['feats'][p].reshape(-1) for p in job['pos']], out=slot['mel_host'].numpy()[:m])
+        slot['mel'][:m].copy_(slot['mel_host'][:m].view(m, 32, 32, 32), non_blocking=True)
+
+    def forward(job, slot):
+        m = job['model_frames']
+        if server is None:
+            slot['pred'] = model(slot['img'][:m], slot['mel'][:m])
+        else: # 与其他会话合并成一个batch
+            slot['pred'] = server(slot['img'][:m], slot['mel'][:m])
+
+    def post(job, slot):
+        index, audio_frames = job['index'], job['audio_frames']
+        if slot is None: # 静音, post失败后只补还没推出的帧
+            for i in range(job.get('emitted', 0), job['n']):
+                res_frame_queue.put((None, __mirror_index(length, index + i), audio_frames[i*2:i*2+2]))
+            return
+        m = job['model_frames']
+        res = slot['res_host'][:m]
+        res.copy_(slot['pred'].mul_(255.).permute(0, 2, 3, 1)) # uint8, 与astype一样截断
+        slot['pred'] = None
+        res = res.numpy()
+        # 帧在res_frame_queue里的时间比slot长，interp_frames给出的是副本
+        for i, res_frame in enumerate(interp_frames(res, job['pos'], job['n'])):
+            res_frame_queue.put((res_frame, __mirror_index(length, index + i), audio_frames[i*2:i*2+2]))
+            job['emitted'] = i + 1
+
+    pipe = InferPipeline(prepare, forward, post, make_slot, threaded=pipelined, device=device, name='ultralight', slo=slo)
     index = 0
-    count = 0
-    counttime = 0
     logger.info('start inference')
 
     while not quit_event.is_set():
-        starttime=time.perf_counter()
         try:
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
+        n = len(mel_batch) #smaller than batch_size with --adaptive_batch
         is_all_silence=True
         audio_frames = []
-        for _ in range(batch_size*2):
+        for _ in range(n*2):
             frame,type_,eventpoint = audio_out_queue.get()
             audio_frames.append((frame,type_,eventpoint))
             if type_==0:
                 is_all_silence=False
-        if is_all_silence:
-            for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
+        job = {'n': n, 'index': index, 'audio_frames': audio_frames}
+        slo_level = slo.level if slo is not None else NORMAL
+        if is_all_silence or slo_level >= IDLE: #slo idle: no model, process_frames shows the idle frame
+            pipe.submit(job, silence=True)
         else:
-            t = time.perf_counter()
-            img_batch = []
-
-            for i in range(batch_size):
-                idx = __mirror_index(length, index + i)
-                #face = face_list_cycle[idx]
-                crop_img = face_list_cycle[idx] #face[ymin:ymax, xmin:xmax]
-#                h, w = crop_img.shape[:2]
-                #crop_img = cv2.resize(crop_img, (168, 168), cv2.INTER_AREA)
-                #crop_img_ori = crop_img.copy()
-                img_real_ex = crop_img[4:164, 4:164].copy()
-                img_real_ex_ori = img_real_ex.copy()
-                img_masked = cv2.rectangle(img_real_ex_ori,(5,5,150,145),(0,0,0),-1)
-    
-                img_masked = img_masked.transpose(2,0,1).astype(np.float32)
-                img_real_ex = img_real_ex.transpose(2,0,1).astype(np.float32)
-    
-                img_real_ex_T = torch.from_numpy(img_real_ex / 255.0)
-                img_masked_T = torch.from_numpy(img_masked / 255.0)
-                img_concat_T = torch.cat([img_real_ex_T, img_masked_T], axis=0)[None]
-                img_batch.append(img_concat_T)
-
-            reshaped_mel_batch = [arr.reshape(32, 32, 32) for arr in mel_batch]
-            mel_batch = torch.stack([torch.from_numpy(arr) for arr in reshaped_mel_batch])
-            img_batch = torch.stack(img_batch).squeeze(1)
-
-
-            with torch.no_grad():
-                pred = model(img_batch.cuda(),mel_batch.cuda())
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-
-            counttime += (time.perf_counter() - t)
-            count += batch_size
-            if count >= 100:
-                logger.info(f"------actual avg infer fps:{count / counttime:.4f}")
-                count = 0
-                counttime = 0
-            for i,res_frame in enumerate(pred):
-                #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-
-#            for i, pred_frame in enumerate(pred):
-#                pred_frame_uint8 = np.array(pred_frame, dtype=np.uint8)
-#                res_frame_queue.put((pred_frame_uint8, __mirror_index(length, index), audio_frames[i * 2:i * 2 + 2]))
-#                index = (index + 1) % length
-
-        #print('total batch time:', time.perf_counter() - starttime)
+            step = max(decimate, 2 if slo_level >= REUSE else 1) # decimate/slo reuse: 每step帧推理一次，中间帧由前后两帧插值
+            pos = model_positions(n, step)
+            job.update({'feats': mel_batch, 'pos': pos, 'model_frames': len(pos)})
+            pipe.submit(job)
+        index = index + n
 
+    pipe.close()
     logger.info('lightreal inference processor stop')
 
 
@@ -239,7 +285,8 @@ class LightReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         audio_processor = model
-        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.model,self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_tensor = avatar
+        self.frame_list_cycle = session_frames(self.frame_list_cycle) #own playback cursor in a shared ImgCache
 
         self.asr = HubertASR(opt,self,audio_processor)
         self.asr.warm_up()
@@ -249,6 +296,7 @@ class LightReal(BaseReal):
     
     def __del__(self):
         logger.info(f'lightreal({self.sessionid}) delete')
+        super().__del__()
 
    
     def process_frames(self,quit_event,loop=None,audio_track=None,video_track=None):
@@ -286,6 +334,9 @@ class LightReal(BaseReal):
                     # 使用默认的全身图像
                     combine_frame = self.frame_list_cycle[idx]
                     # combine_frame = self.imagecache.get_img(idx)
+            elif res_frame is None: # slo idle: 不推理，显示原始帧
+                self.speaking = True
+                combine_frame = self.frame_list_cycle[idx]
             else:
                 # 非静音帧，需要合成口型动画
                 self.speaking = True  # 标记为说话状态
@@ -356,8 +407,11 @@ class LightReal(BaseReal):
         process_thread.start()
         
         # 启动推理线程
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  # mp.Process
+        server = None
+        if self.opt.batch_server: # 同一个avatar的会话共享一个ultralight模型
+            server = get_batch_server(self.model,self.model,self.opt.batch_server_max,self.opt.batch_server_wait/1000,'ultralight')
+        Thread(target=inference, args=(quit_event,self.batch_size,self.face_tensor,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
+                                           self.model,server,self.slo,not self.opt.no_pipeline,self.opt.decimate)).start()  # mp.Process
         
         # 注释掉的渲染事件设置代码
         # self.render_event.set() # start infer process render
@@ -383,6 +437,8 @@ class LightReal(BaseReal):
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
             
             # 当视频队列大于5时，适当延迟以控制速度
+            if self.slo is not None:
+                self.slo.report_queue(video_track._queue.qsize())
             if video_track._queue.qsize()>=5:
                 logger.debug('sleep qsize=%d',video_track._queue.qsize())
                 time.sleep(0.04*video_track._queue.qsize()*0.8)
@@ -27,38 +27,47 @@ from baseasr import BaseASR
 from wav2lip import audio
 
 class LipASR(BaseASR):
+    def __init__(self, opt, parent=None):
+        super().__init__(opt,parent)
+        self.mel_stream = audio.StreamingMel() #mel of the sliding window, only new columns computed
 
-    def run_step(self):
-        ############################################## extract audio feature ##############################################
-        # get a frame of audio
-        for _ in range(self.batch_size*2):
-            frame,type,eventpoint = self.get_audio_frame()
-            self.frames.append(frame)
-            # put to output
-            self.output_queue.put((frame,type,eventpoint))
-        # context not enough, do not run network.
-        if len(self.frames) <= self.stride_left_size + self.stride_right_size:
-            return
-        
-        inputs = np.concatenate(self.frames) # [N * chunk]
-        mel = audio.melspectrogram(inputs)
-        #print(mel.shape[0],mel.shape,len(mel[0]),len(self.frames))
+    def mel_starts(self,batch_size,length):
+        """first column of every frame in melspectrogram of a window of length samples"""
         # cut off stride
         left = max(0, self.stride_left_size*80/50)
-        right = min(len(mel[0]), len(mel[0]) - self.stride_right_size*80/50)
         mel_idx_multiplier = 80.*2/self.fps 
         mel_step_size = 16
-        i = 0
-        mel_chunks = []
-        while i < (len(self.frames)-self.stride_left_size-self.stride_right_size)/2:
+        mel_len = length//audio.get_hop_size() + 1 #columns of the centered stft
+        starts = []
+        for i in range(batch_size):
             start_idx = int(left + i * mel_idx_multiplier)
             #print(start_idx)
-            if start_idx + mel_step_size > len(mel[0]):
-                mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
+            if start_idx + mel_step_size > mel_len:
+                starts.append(mel_len - mel_step_size)
             else:
-                mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-            i += 1
-        self.feat_queue.put(mel_chunks)
-        
-        # discard the old part to save memory
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+                starts.append(start_idx)
+        return starts
+
+    def frame_span(self,i):
+        # chunks under the 16 mel columns of the frame, n_fft stft windows centered every hop samples.
+        # preemphasis adds the sample before
+        hop,half = audio.get_hop_size(),audio.hp.n_fft//2
+        s = self.mel_starts(i+1,len(self.frame_types)*self.chunk)[i]*hop
+        return (s-half-1)//self.chunk, (s+15*hop+half)//self.chunk + 1
+
+    def extract_chunks(self,inputs,batch_size,start=None,silent=()):
+        mel_step_size = 16
+        starts = self.mel_starts(batch_size,len(inputs))
+        if start is not None: #window of the stream, transform only what the chunks use and was not seen yet
+            silent = set(silent)
+            cols = sorted(set(c for i,s in enumerate(starts) if i not in silent for c in range(s, s+mel_step_size)))
+            self.mel_stream.feed(inputs,start)
+            columns = self.mel_stream.columns(start,len(inputs),cols) if cols else None
+            if columns is not None:
+                first = min(starts)
+                mel = np.zeros((columns.shape[0],max(starts)+mel_step_size-first))
+                mel[:, np.array(cols)-first] = columns
+                return [mel[:, s-first : s-first + mel_step_size] for s in starts]
+        mel = audio.melspectrogram(inputs)
+        #print(mel.shape[0],mel.shape,len(mel[0]),len(self.frames))
+        return [mel[:, s : s + mel_step_size] for s in starts]
@@ -20,16 +20,14 @@ import torch
 import numpy as np
 
 #from .utils import *
-import os
 import time
 import cv2
-import glob
 import pickle
 import copy
 
 import queue
 from queue import Queue
-from threading import Thread, Event
+from threading import Thread, Event, Lock
 import torch.multiprocessing as mp
 
 
@@ -37,11 +35,18 @@ from lipasr import LipASR
 import asyncio
 from av import AudioFrame, VideoFrame
 from wav2lip.models import Wav2Lip
-from basereal import BaseReal
+from basereal import BaseReal,mirror_indices
+from slo import NORMAL,REUSE,IDLE
+from inferpipe import InferPipeline,pinned_empty,model_positions,interp_frames
+from inferserver import get_batch_server
+from inferproc import get_infer_process
+from inferbackend import load_backend
+from quantize import quantize_lipsync,calib_speech,calib_rows
+from wav2lip import audio
+from avatarstore import load_images,open_bundle,bundle_path,frames_array
+
+from imgcache import load_frames,session_frames
 
-#from imgcache import ImgCache
-
-from tqdm import tqdm
 from logger import logger
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -55,7 +60,7 @@ def _load(checkpoint_path):
 								map_location=lambda storage, loc: storage)
 	return checkpoint
 
-def load_model(path):
+def load_model(path,backend='torch',threads=0,batch_size=1):
 	model = Wav2Lip()
 	logger.info("Load checkpoint from: {}".format(path))
 	checkpoint = _load(path)
@@ -65,26 +70,70 @@ def load_model(path):
 		new_s[k.replace('module.', '')] = v
 	model.load_state_dict(new_s)
 
-	model = model.to(device)
-	return model.eval()
+	model = model.to(device).eval()
+	example = (torch.ones(batch_size, 1, 80, 16).to(device), torch.ones(batch_size, 6, 256, 256).to(device))
+	return load_backend(model, example, path, backend, device, threads, 'wav2lip')
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,imgcache_size=0,with_tensor=True):
     avatar_path = f"./data/avatars/{avatar_id}"
     full_imgs_path = f"{avatar_path}/full_imgs" 
-    face_imgs_path = f"{avatar_path}/face_imgs" 
-    coords_path = f"{avatar_path}/coords.pkl"
     
-    with open(coords_path, 'rb') as f:
+    bundle = open_bundle(bundle_path(avatar_path))
+    coord_list_cycle,face_list_cycle = load_faces(avatar_path,bundle)
+    #with imgcache_size full_imgs are streamed from disk with a bounded memory budget
+    frame_list_cycle = load_frames(full_imgs_path,len(coord_list_cycle),imgcache_size,bundle)
+
+    #with --infer_process the worker process holds the face tensor
+    face_tensor = prepare_face_tensor(face_list_cycle) if with_tensor else None
+    return frame_list_cycle,face_list_cycle,coord_list_cycle,face_tensor
+
+def load_faces(avatar_path,bundle=None):
+    if bundle is not None:
+        return bundle.coords('coords'),bundle.images('face_imgs')
+    with open(f"{avatar_path}/coords.pkl", 'rb') as f:
         coord_list_cycle = pickle.load(f)
-    input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
-    #self.imagecache = ImgCache(len(self.coord_list_cycle),self.full_imgs_path,1000)
-    input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_face_list = sorted(input_face_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    face_list_cycle = read_imgs(input_face_list)
+    return coord_list_cycle,load_images(f"{avatar_path}/face_imgs")
+
+def prepare_face_tensor(face_list_cycle, dtype=None, chunk=64):
+    """
+    model image input of every avatar frame, [N,6,H,W] on device:
+    face with the lower half masked, then the reference face, scaled to 0..1.
+    it only depends on the frame index, so inference just gathers rows of it.
+    fp16 on cuda to halve the memory, fp32 on cpu
+    """
+    if dtype is None:
+        dtype = torch.float16 if device == 'cuda' else torch.float32
+    length = len(face_list_cycle)
+    h,w = face_list_cycle[0].shape[:2]
+    face_tensor = torch.empty((length,6,h,w), dtype=dtype, device=device)
+    face_array = frames_array(face_list_cycle) #packed faces are sliced without a python list
+    for start in range(0, length, chunk):
+        if face_array is not None:
+            faces = np.array(face_array[start:start+chunk])
+        else:
+            faces = np.asarray([face_list_cycle[i] for i in range(start, min(start+chunk, length))])
+        faces = torch.from_numpy(faces).to(device).permute(0,3,1,2).float().div(255.).to(dtype)
+        end = start + len(faces)
+        face_tensor[start:end, 3:] = faces
+        face_tensor[start:end, :3] = faces
+        face_tensor[start:end, :3, h//2:] = 0
+    return face_tensor
 
-    return frame_list_cycle,face_list_cycle,coord_list_cycle
+@torch.no_grad()
+def quantize_model(model,face_tensor,mode,calib_wav=None,batch_size=8,batches=4):
+    """--quantize, calibrated on the avatar's face frames with the mel of calib_speech"""
+    if mode == 'none':
+        return model
+    mel = audio.melspectrogram(calib_speech(calib_wav))
+    rows = calib_rows(len(face_tensor), batches*batch_size)
+    calib = []
+    for start in range(0, len(rows), batch_size):
+        idx = rows[start:start+batch_size]
+        mel_starts = [min(int(i*80./25), mel.shape[1]-16) for i in range(start, start+len(idx))] #25fps video, 80 mel/s
+        mel_batch = torch.from_numpy(np.stack([mel[:, s:s+16] for s in mel_starts])).float().unsqueeze(1)
+        img_batch = face_tensor[torch.from_numpy(idx).to(face_tensor.device)].float().cpu()
+        calib.append((mel_batch, img_batch))
+    return quantize_lipsync(model, calib, mode, 'wav2lip')
 
 @torch.no_grad()
 def warm_up(batch_size,model,modelres):
@@ -94,14 +143,6 @@ def warm_up(batch_size,model,modelres):
     mel_batch = torch.ones(batch_size, 1, 80, 16).to(device)
     model(mel_batch, img_batch)
 
-def read_imgs(img_list):
-    frames = []
-    logger.info('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
-
 def __mirror_index(size, index):
     #size = len(self.coord_list_cycle)
     turn = index // size
@@ -111,7 +152,7 @@ def __mirror_index(size, index):
     else:
         return size - res - 1 
 
-def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,model):
+def inference(quit_event,batch_size,face_tensor,audio_feat_queue,audio_out_queue,res_frame_queue,model,server=None,slo=None,pipelined=True,decimate=1):
     
     #model = load_model("./models/wav2lip.pth")
     # input_face_list = glob.glob(os.path.join(face_imgs_path, '*.[jpJP][pnPN]*[gG]'))
@@ -119,68 +160,117 @@ def inference(quit_event,batch_size,face_list_cycle,audio_feat_queue,audio_out_q
     # face_list_cycle = read_imgs(input_face_list)
     
     #input_latent_list_cycle = torch.load(latents_out_path)
-    length = len(face_list_cycle)
+    length = face_tensor.shape[0]
+    h,w = face_tensor.shape[2:]
+
+    def make_slot():
+        slot = {'idx':pinned_empty((batch_size,),torch.int64,device),
+                'idx_dev':torch.empty((batch_size,),dtype=torch.int64,device=device),
+                'img':torch.empty((batch_size,6,h,w),dtype=torch.float32,device=device),
+                'mel_host':pinned_empty((batch_size,1,80,16),torch.float32,device),
+                'mel':torch.empty((batch_size,1,80,16),dtype=torch.float32,device=device),
+                'res_host':pinned_empty((batch_size,h,w,3),torch.uint8,device)}
+        slot['gather'] = slot['img'] if face_tensor.dtype == torch.float32 else torch.empty((batch_size,6,h,w),dtype=face_tensor.dtype,device=device)
+        return slot
+
+    def prepare(job,slot):
+        m = job['model_frames']
+        slot['idx'].numpy()[:m] = mirror_indices(length,job['index'],job['n'])[job['pos']]
+        idx = slot['idx_dev'][:m]
+        idx.copy_(slot['idx'][:m], non_blocking=True)
+        torch.index_select(face_tensor, 0, idx, out=slot['gather'][:m])
+        if slot['gather'] is not slot['img']:
+            slot['img'][:m].copy_(slot['gather'][:m])
+        np.stack([job['feats'][p] for p in job['pos']], out=slot['mel_host'].numpy()[:m,0])
+        slot['mel'][:m].copy_(slot['mel_host'][:m], non_blocking=True)
+
+    def forward(job,slot):
+        m = job['model_frames']
+        if server is None:
+            slot['pred'] = model(slot['mel'][:m], slot['img'][:m])
+        else: #batched together with the other sessions
+            slot['pred'] = server(slot['mel'][:m], slot['img'][:m])
+
+    def post(job,slot):
+        index,audio_frames = job['index'],job['audio_frames']
+        if slot is None: #silence, after a failed post the frames not pushed yet
+            for i in range(job.get('emitted',0),job['n']):
+                res_frame_queue.put((None,__mirror_index(length,index+i),audio_frames[i*2:i*2+2]))
+            return
+        m = job['model_frames']
+        res = slot['res_host'][:m]
+        res.copy_(slot['pred'].mul_(255.).permute(0, 2, 3, 1)) #uint8, truncated like astype
+        slot['pred'] = None
+        res = res.numpy()
+        # frames outlive the slot in res_frame_queue, interp_frames hands out copies
+        for i,res_frame in enumerate(interp_frames(res,job['pos'],job['n'])):
+            res_frame_queue.put((res_frame,__mirror_index(length,index+i),audio_frames[i*2:i*2+2]))
+            job['emitted'] = i+1
+
+    pipe = InferPipeline(prepare,forward,post,make_slot,threaded=pipelined,device=device,name='wav2lip',slo=slo)
     index = 0
-    count=0
-    counttime=0
     logger.info('start inference')
     while not quit_event.is_set():
-        starttime=time.perf_counter()
-        mel_batch = []
         try:
             mel_batch = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
+        n = len(mel_batch) #smaller than batch_size with --adaptive_batch
             
         is_all_silence=True
         audio_frames = []
-        for _ in range(batch_size*2):
+        for _ in range(n*2):
             frame,type,eventpoint = audio_out_queue.get()
             audio_frames.append((frame,type,eventpoint))
             if type==0:
                 is_all_silence=False
 
-        if is_all_silence:
-            for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
+        job = {'n':n,'index':index,'audio_frames':audio_frames}
+        slo_level = slo.level if slo is not None else NORMAL
+        if is_all_silence or slo_level >= IDLE: #slo idle: no model, process_frames shows the idle frame
+            pipe.submit(job, silence=True)
         else:
-            # print('infer=======')
-            t=time.perf_counter()
-            img_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                face = face_list_cycle[idx]
-                img_batch.append(face)
-            img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-            img_masked = img_batch.copy()
-            img_masked[:, face.shape[0]//2:] = 0
-
-            img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-            mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
-            
-            img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-            mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
-
-            with torch.no_grad():
-                pred = model(mel_batch, img_batch)
-            pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-
-            counttime += (time.perf_counter() - t)
-            count += batch_size
-            #_totalframe += 1
-            if count>=100:
-                logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
-                count=0
-                counttime=0
-            for i,res_frame in enumerate(pred):
-                #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-            #print('total batch time:',time.perf_counter()-starttime)            
+            step = max(decimate, 2 if slo_level >= REUSE else 1) #decimate/slo reuse: model on every step-th frame
+            pos = model_positions(n,step)
+            job.update({'feats':mel_batch,'pos':pos,'model_frames':len(pos)})
+            pipe.submit(job)
+        index = index + n
+    pipe.close()
     logger.info('lipreal inference processor stop')
 
+def process_setup(batch_size,backend='torch',threads=0,quantize='none',calib_wav=None,batch_server=False,max_batch=0,max_wait=0.01):
+    """--infer_process worker, the model shared by its sessions"""
+    model = load_model("./models/wav2lip.pth",backend if quantize=='none' else 'torch',threads,batch_size)
+    if quantize == 'none': #else after quantizing on the first avatar
+        warm_up(batch_size,model,256)
+    return {'model':model,'quantize':quantize,'calib_wav':calib_wav,'batch_server':(batch_server,max_batch,max_wait),
+            'server':None,'faces':{},'lock':Lock()}
+
+def process_inference(quit_event,batch_size,audio_feat_queue,audio_out_queue,res_frame_queue,worker,avatar_id,pipelined=True,decimate=1):
+    """--infer_process session, the face tensor of an avatar is loaded once for the sessions using it"""
+    with worker['lock']:
+        entry = worker['faces'].get(avatar_id)
+        if entry is None:
+            avatar_path = f"./data/avatars/{avatar_id}"
+            _,face_list_cycle = load_faces(avatar_path,open_bundle(bundle_path(avatar_path)))
+            entry = worker['faces'][avatar_id] = [prepare_face_tensor(face_list_cycle),0]
+            if worker['quantize'] != 'none': #calibrated on the faces of the first avatar
+                worker['model'] = quantize_model(worker['model'],entry[0],worker['quantize'],worker['calib_wav'])
+                worker['quantize'] = 'none'
+                warm_up(batch_size,worker['model'],entry[0].shape[2])
+        entry[1] += 1
+        batch_server,max_batch,max_wait = worker['batch_server']
+        if batch_server and worker['server'] is None: #one forward for the batches of all sessions
+            worker['server'] = get_batch_server(worker['model'],worker['model'],max_batch,max_wait,'wav2lip')
+    try:
+        inference(quit_event,batch_size,entry[0],audio_feat_queue,audio_out_queue,res_frame_queue,
+                  worker['model'],worker['server'],None,pipelined,decimate)
+    finally:
+        with worker['lock']:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del worker['faces'][avatar_id]
+
 class LipReal(BaseReal):
     @torch.no_grad()
     def __init__(self, opt, model, avatar):
@@ -196,7 +286,8 @@ class LipReal(BaseReal):
         self.res_frame_queue = Queue(self.batch_size*2)  #mp.Queue
         #self.__loadavatar()
         self.model = model
-        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle = avatar
+        self.frame_list_cycle,self.face_list_cycle,self.coord_list_cycle,self.face_tensor = avatar
+        self.frame_list_cycle = session_frames(self.frame_list_cycle) #own playback cursor in a shared ImgCache
 
         self.asr = LipASR(opt,self)
         self.asr.warm_up()
@@ -205,6 +296,7 @@ class LipReal(BaseReal):
     
     def __del__(self):
         logger.info(f'lipreal({self.sessionid}) delete')
+        super().__del__()
 
    
     def process_frames(self,quit_event,loop=None,audio_track=None,video_track=None):
@@ -226,6 +318,9 @@ class LipReal(BaseReal):
                 else:
                     combine_frame = self.frame_list_cycle[idx]
                     #combine_frame = self.imagecache.get_img(idx)
+            elif res_frame is None: #slo idle level
+                self.speaking = True
+                combine_frame = self.frame_list_cycle[idx]
             else:
                 self.speaking = True
                 bbox = self.coord_list_cycle[idx]
@@ -268,9 +363,21 @@ class LipReal(BaseReal):
         process_thread = Thread(target=self.process_frames, args=(quit_event,loop,audio_track,video_track))
         process_thread.start()
 
-        Thread(target=inference, args=(quit_event,self.batch_size,self.face_list_cycle,
-                                           self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.model,)).start()  #mp.Process
+        if self.opt.infer_process: #model in a worker process shared by the sessions, features and frames through shared memory
+            worker = get_infer_process('wav2lip',process_setup,(self.batch_size,self.opt.infer_backend,self.opt.infer_threads,
+                                                                self.opt.quantize,self.opt.quantize_calib,self.opt.batch_server,
+                                                                self.opt.batch_server_max,self.opt.batch_server_wait/1000),
+                                       process_inference,self.opt.max_session,self.batch_size,(80,16),np.float32,
+                                       tuple(self.face_list_cycle[0].shape),'wav2lip')
+            Thread(target=worker.run, args=(quit_event,self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
+                                            getattr(self,'avatar_id',self.opt.avatar_id),not self.opt.no_pipeline,self.opt.decimate)).start()
+        else:
+            server = None
+            if self.opt.batch_server:
+                server = get_batch_server(self.model,self.model,self.opt.batch_server_max,self.opt.batch_server_wait/1000,'wav2lip')
+            Thread(target=inference, args=(quit_event,self.batch_size,self.face_tensor,
+                                               self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
+                                               self.model,server,self.slo,not self.opt.no_pipeline,self.opt.decimate)).start()  #mp.Process
 
         #self.render_event.set() #start infer process render
         count=0
@@ -286,6 +393,8 @@ class LipReal(BaseReal):
             # if video_track._queue.qsize()>=2*self.opt.batch_size:
             #     print('sleep qsize=',video_track._queue.qsize())
             #     time.sleep(0.04*video_track._queue.qsize()*0.8)
+            if self.slo is not None:
+                self.slo.report_queue(video_track._queue.qsize())
             if video_track._queue.qsize()>=5:
                 logger.debug('sleep qsize=%d',video_track._queue.qsize())
                 time.sleep(0.04*video_track._queue.qsize()*0.8)
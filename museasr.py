@@ -22,32 +22,28 @@ import queue
 from queue import Queue
 #import multiprocessing as mp
 from baseasr import BaseASR
-from musetalk.whisper.audio2feature import Audio2Feature
+from functools import partial
+from musetalk.whisper.audio2feature import Audio2Feature,LogMelStream,encoder_embeddings
+from inferserver import get_batch_server
 
 class MuseASR(BaseASR):
     def __init__(self, opt, parent,audio_processor:Audio2Feature):
         super().__init__(opt,parent)
         self.audio_processor = audio_processor
+        self.audio_feat_length = [2,2]
+        self.mel_stream = LogMelStream() #log-mel of the overlapping context is reused with --whisper_window
+        self.encoder = None
+        if getattr(opt,'asr_batch_server',False): #one whisper forward for the windows of all sessions
+            self.encoder = get_batch_server(audio_processor.model,partial(encoder_embeddings,audio_processor),0,
+                                            opt.batch_server_wait/1000,'whisper')
 
-    def run_step(self):
-        ############################################## extract audio feature ##############################################
-        start_time = time.time()
-        for _ in range(self.batch_size*2):
-            audio_frame,type,eventpoint = self.get_audio_frame()
-            self.frames.append(audio_frame)
-            self.output_queue.put((audio_frame,type,eventpoint))
-        
-        if len(self.frames) <= self.stride_left_size + self.stride_right_size:
-            return
-        
-        inputs = np.concatenate(self.frames) # [N * chunk]
-        whisper_feature = self.audio_processor.audio2feat(inputs)
-        # for feature in whisper_feature:
-        #     self.audio_feats.append(feature)        
-        #print(f"processing audio costs {(time.time() - start_time) * 1000}ms, inputs shape:{inputs.shape} whisper_feature len:{len(whisper_feature)}")
-        whisper_chunks = self.audio_processor.feature2chunks(feature_array=whisper_feature,fps=self.fps/2,batch_size=self.batch_size,start=self.stride_left_size/2 )
-        #print(f"whisper_chunks len:{len(whisper_chunks)},self.audio_feats len:{len(self.audio_feats)},self.output_queue len:{self.output_queue.qsize()}")
-        #self.audio_feats = self.audio_feats[-(self.stride_left_size + self.stride_right_size):]
-        self.feat_queue.put(whisper_chunks)
-        # discard the old part to save memory
-        self.frames = self.frames[-(self.stride_left_size + self.stride_right_size):]
+    def frame_span(self,i):
+        # whisper frames of the feature slice and the encoder convolutions. the encoder attends to the
+        # whole window, so speech outside of the span only changes the feature slightly
+        center = self.stride_left_size + 2*i
+        return center-6,center+8
+
+    def audio_feature(self,inputs,start=None):
+        if self.audio_processor.window > 0 or self.encoder is not None:
+            return self.audio_processor.audio2feat_window(inputs,self.mel_stream,start,self.encoder)
+        return self.audio_processor.audio2feat(inputs)
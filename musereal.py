@@ -21,13 +21,11 @@ import numpy as np
 
 #from .utils import *
 import subprocess
-import os
 import time
 import torch.nn.functional as F
 import cv2
-import glob
 import pickle
-import copy
+from functools import partial
 
 import queue
 from queue import Queue
@@ -36,14 +34,18 @@ import torch.multiprocessing as mp
 
 from musetalk.utils.utils import get_file_type,get_video_fps,datagen
 #from musetalk.utils.preprocessing import get_landmark_and_bbox,read_imgs,coord_placeholder
-from musetalk.utils.blending import get_image,get_image_prepare_material,get_image_blending
+from musetalk.utils.blending import get_image,get_image_prepare_material,prepare_blend_alpha,blend_face
 from musetalk.utils.utils import load_all_model,load_diffusion_model,load_audio_model
 from musetalk.whisper.audio2feature import Audio2Feature
 
 from museasr import MuseASR
 import asyncio
 from av import AudioFrame, VideoFrame
-from basereal import BaseReal
+from basereal import BaseReal,mirror_indices
+from slo import NORMAL,REUSE,IDLE
+from inferpipe import InferPipeline,pinned_empty,model_positions,interp_frames
+from inferserver import get_batch_server
+from avatarstore import load_images,open_bundle,bundle_path
 
 from tqdm import tqdm
 from logger import logger
@@ -60,7 +62,7 @@ def load_model():
     #unet.model.share_memory()
     return vae, unet, pe, timesteps, audio_processor
 
-def load_avatar(avatar_id):
+def load_avatar(avatar_id,fixed_point_blend=False):
     #self.video_path = '' #video_path
     #self.bbox_shift = opt.bbox_shift
     avatar_path = f"./data/avatars/{avatar_id}"
@@ -77,18 +79,37 @@ def load_avatar(avatar_id):
     #     "bbox_shift":self.bbox_shift   
     # }
 
-    input_latent_list_cycle = torch.load(latents_out_path)  #,weights_only=True
+    bundle = open_bundle(bundle_path(avatar_path))
+    if bundle is not None:
+        latent_bank = make_latent_bank(torch.from_numpy(np.array(bundle.array('latents'))))
+        coord_list_cycle = bundle.coords('coords')
+        frame_list_cycle = bundle.images('full_imgs')
+        mask_coords_list_cycle = bundle.coords('mask_coords')
+        mask_list_cycle = bundle.images('mask')
+        alpha_list_cycle = prepare_alphas(mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,fixed_point_blend)
+        return frame_list_cycle,alpha_list_cycle,coord_list_cycle,latent_bank
+
+    latent_bank = make_latent_bank(torch.cat(torch.load(latents_out_path), dim=0))  #,weights_only=True
     with open(coords_path, 'rb') as f:
         coord_list_cycle = pickle.load(f)
-    input_img_list = glob.glob(os.path.join(full_imgs_path, '*.[jpJP][pnPN]*[gG]'))
-    input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    frame_list_cycle = read_imgs(input_img_list)
+    frame_list_cycle = load_images(full_imgs_path)
     with open(mask_coords_path, 'rb') as f:
         mask_coords_list_cycle = pickle.load(f)
-    input_mask_list = glob.glob(os.path.join(mask_out_path, '*.[jpJP][pnPN]*[gG]'))
-    input_mask_list = sorted(input_mask_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
-    mask_list_cycle = read_imgs(input_mask_list)
-    return frame_list_cycle,mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,input_latent_list_cycle
+    mask_list_cycle = load_images(mask_out_path)
+    alpha_list_cycle = prepare_alphas(mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,fixed_point_blend)
+    return frame_list_cycle,alpha_list_cycle,coord_list_cycle,latent_bank
+
+def make_latent_bank(latents, dtype=torch.float16):
+    # all frame latents as one contiguous [N,8,32,32] tensor, already in the unet dtype (fp16, see load_model).
+    # shared read-only by every session of the avatar, batches are gathered from it
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return latents.to(device=device, dtype=dtype).contiguous()
+
+def prepare_alphas(mask_list_cycle,coord_list_cycle,mask_coords_list_cycle,fixed_point=False):
+    # the masks are only needed as blend weights inside the face box, convert them once
+    logger.info('prepare blend masks...')
+    return [prepare_blend_alpha(mask_list_cycle[i],coord_list_cycle[i],mask_coords_list_cycle[i],fixed_point)
+            for i in tqdm(range(len(mask_list_cycle)))]
 
 @torch.no_grad()
 def warm_up(batch_size,model):
@@ -109,14 +130,6 @@ def warm_up(batch_size,model):
                               encoder_hidden_states=audio_feature_batch).sample
     vae.decode_latents(pred_latents)
 
-def read_imgs(img_list):
-    frames = []
-    logger.info('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
-
 def __mirror_index(size, index):
     #size = len(self.coord_list_cycle)
     turn = index // size
@@ -127,8 +140,15 @@ def __mirror_index(size, index):
         return size - res - 1 
 
 @torch.no_grad()
-def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,audio_out_queue,res_frame_queue,
-              vae, unet, pe,timesteps): #vae, unet, pe,timesteps
+def unet_decode(vae,unet,timesteps,latent_batch,audio_feature_batch):
+    pred_latents = unet.model(latent_batch, 
+                                timesteps, 
+                                encoder_hidden_states=audio_feature_batch).sample
+    return vae.decode_latents(pred_latents)
+
+@torch.no_grad()
+def inference(render_event,batch_size,latent_bank,audio_feat_queue,audio_out_queue,res_frame_queue,
+              vae, unet, pe,timesteps,server=None,slo=None,pipelined=True,decimate=1): #vae, unet, pe,timesteps
     
     # vae, unet, pe = load_diffusion_model()
     # device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -137,73 +157,81 @@ def inference(render_event,batch_size,input_latent_list_cycle,audio_feat_queue,a
     # vae.vae = vae.vae.half()
     # unet.model = unet.model.half()
     
-    length = len(input_latent_list_cycle)
+    length = latent_bank.shape[0]
+    device = latent_bank.device
+    # latent row of every step of one ping-pong period, batch i uses rows (index+0..batch_size-1) % period
+    mirror_table = torch.from_numpy(mirror_indices(length,0,2*length)).to(device)
+    steps = torch.arange(batch_size, device=device)
+
+    def make_slot():
+        return {'latent':torch.empty((batch_size,)+latent_bank.shape[1:],dtype=unet.model.dtype,device=device),
+                'whisper_host':pinned_empty((batch_size,50,384),torch.float32,device),
+                'whisper':torch.empty((batch_size,50,384),dtype=unet.model.dtype,device=device)}
+
+    def prepare(job,slot):
+        m = job['model_frames']
+        rows = mirror_table[(job['index'] + steps[torch.from_numpy(job['pos'])]) % (2*length)]
+        if latent_bank.dtype == slot['latent'].dtype:
+            torch.index_select(latent_bank, 0, rows, out=slot['latent'][:m])
+        else:
+            slot['latent'][:m].copy_(latent_bank.index_select(0, rows))
+        np.stack([job['feats'][p] for p in job['pos']], out=slot['whisper_host'].numpy()[:m])
+        slot['whisper'][:m].copy_(slot['whisper_host'][:m], non_blocking=True)
+        slot['audio_feature'] = pe(slot['whisper'][:m])
+
+    def forward(job,slot):
+        m = job['model_frames']
+        if server is None:
+            slot['pred_latents'] = unet.model(slot['latent'][:m], 
+                                              timesteps, 
+                                              encoder_hidden_states=slot['audio_feature']).sample
+        else: #unet and vae batched together with the other sessions
+            slot['recon'] = server(slot['latent'][:m],slot['audio_feature'])
+        slot['audio_feature'] = None
+
+    def post(job,slot):
+        index,audio_frames = job['index'],job['audio_frames']
+        if slot is None: #silence, after a failed post the frames not pushed yet
+            for i in range(job.get('emitted',0),job['n']):
+                res_frame_queue.put((None,__mirror_index(length,index+i),audio_frames[i*2:i*2+2]))
+            return
+        if server is None:
+            recon = vae.decode_latents(slot['pred_latents'])
+            slot['pred_latents'] = None
+        else:
+            recon = slot['recon']
+            slot['recon'] = None
+        for i,res_frame in enumerate(interp_frames(recon,job['pos'],job['n'])):
+            res_frame_queue.put((res_frame,__mirror_index(length,index+i),audio_frames[i*2:i*2+2]))
+            job['emitted'] = i+1
+
+    pipe = InferPipeline(prepare,forward,post,make_slot,threaded=pipelined,device=device,name='musetalk',slo=slo)
     index = 0
-    count=0
-    counttime=0
     logger.info('start inference')
     while render_event.is_set():
-        starttime=time.perf_counter()
         try:
             whisper_chunks = audio_feat_queue.get(block=True, timeout=1)
         except queue.Empty:
             continue
+        n = len(whisper_chunks) #smaller than batch_size with --adaptive_batch
         is_all_silence=True
         audio_frames = []
-        for _ in range(batch_size*2):
+        for _ in range(n*2):
             frame,type,eventpoint = audio_out_queue.get()
             audio_frames.append((frame,type,eventpoint))
             if type==0:
                 is_all_silence=False
-        if is_all_silence:
-            for i in range(batch_size):
-                res_frame_queue.put((None,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
+        job = {'n':n,'index':index,'audio_frames':audio_frames}
+        slo_level = slo.level if slo is not None else NORMAL
+        if is_all_silence or slo_level >= IDLE: #slo idle: no model, process_frames shows the idle frame
+            pipe.submit(job, silence=True)
         else:
-            # print('infer=======')
-            t=time.perf_counter()
-            whisper_batch = np.stack(whisper_chunks)
-            latent_batch = []
-            for i in range(batch_size):
-                idx = __mirror_index(length,index+i)
-                latent = input_latent_list_cycle[idx]
-                latent_batch.append(latent)
-            latent_batch = torch.cat(latent_batch, dim=0)
-            
-            # for i, (whisper_batch,latent_batch) in enumerate(gen):
-            audio_feature_batch = torch.from_numpy(whisper_batch)
-            audio_feature_batch = audio_feature_batch.to(device=unet.device,
-                                                            dtype=unet.model.dtype)
-            audio_feature_batch = pe(audio_feature_batch)
-            latent_batch = latent_batch.to(dtype=unet.model.dtype)
-            # print('prepare time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-
-            pred_latents = unet.model(latent_batch, 
-                                        timesteps, 
-                                        encoder_hidden_states=audio_feature_batch).sample
-            # print('unet time:',time.perf_counter()-t)
-            # t=time.perf_counter()
-            recon = vae.decode_latents(pred_latents)
-            # infer_inqueue.put((whisper_batch,latent_batch,sessionid))
-            # recon,outsessionid = infer_outqueue.get()
-            # if outsessionid != sessionid:
-            #     print('outsessionid:',outsessionid,' mysessionid:',sessionid)
-
-            # print('vae time:',time.perf_counter()-t)
-            #print('diffusion len=',len(recon))
-            counttime += (time.perf_counter() - t)
-            count += batch_size
-            #_totalframe += 1
-            if count>=100:
-                logger.info(f"------actual avg infer fps:{count/counttime:.4f}")
-                count=0
-                counttime=0
-            for i,res_frame in enumerate(recon):
-                #self.__pushmedia(res_frame,loop,audio_track,video_track)
-                res_frame_queue.put((res_frame,__mirror_index(length,index),audio_frames[i*2:i*2+2]))
-                index = index + 1
-            #print('total batch time:',time.perf_counter()-starttime)            
+            step = max(decimate, 2 if slo_level >= REUSE else 1) #decimate/slo reuse: model on every step-th frame
+            pos = model_positions(n,step)
+            job.update({'feats':whisper_chunks,'pos':pos,'model_frames':len(pos)})
+            pipe.submit(job)
+        index = index + n
+    pipe.close()
     logger.info('musereal inference processor stop')
 
 class MuseReal(BaseReal):
@@ -221,7 +249,7 @@ class MuseReal(BaseReal):
         self.res_frame_queue = mp.Queue(self.batch_size*2)
 
         self.vae, self.unet, self.pe, self.timesteps, self.audio_processor = model
-        self.frame_list_cycle,self.mask_list_cycle,self.coord_list_cycle,self.mask_coords_list_cycle, self.input_latent_list_cycle = avatar
+        self.frame_list_cycle,self.alpha_list_cycle,self.coord_list_cycle,self.latent_bank = avatar
         #self.__loadavatar()
 
         self.asr = MuseASR(opt,self,self.audio_processor)
@@ -231,6 +259,7 @@ class MuseReal(BaseReal):
 
     def __del__(self):
         logger.info(f'musereal({self.sessionid}) delete')
+        super().__del__()
     
 
     def __mirror_index(self, index):
@@ -246,12 +275,8 @@ class MuseReal(BaseReal):
         self.asr.run_step()
         whisper_chunks = self.asr.get_next_feat()
         whisper_batch = np.stack(whisper_chunks)
-        latent_batch = []
-        for i in range(self.batch_size):
-            idx = self.__mirror_index(self.idx+i)
-            latent = self.input_latent_list_cycle[idx]
-            latent_batch.append(latent)
-        latent_batch = torch.cat(latent_batch, dim=0)
+        idx = torch.from_numpy(mirror_indices(len(self.coord_list_cycle),self.idx,self.batch_size))
+        latent_batch = self.latent_bank.index_select(0, idx.to(self.latent_bank.device))
         logger.info('infer=======')
         # for i, (whisper_batch,latent_batch) in enumerate(gen):
         audio_feature_batch = torch.from_numpy(whisper_batch)
@@ -284,20 +309,21 @@ class MuseReal(BaseReal):
                     #     self.curr_state = 1  #当前视频不循环播放，切换到静音状态
                 else:
                     combine_frame = self.frame_list_cycle[idx]
+            elif res_frame is None: #slo idle level
+                self.speaking = True
+                combine_frame = self.frame_list_cycle[idx]
             else:
                 self.speaking = True
                 bbox = self.coord_list_cycle[idx]
-                ori_frame = copy.deepcopy(self.frame_list_cycle[idx])
                 x1, y1, x2, y2 = bbox
                 try:
                     res_frame = cv2.resize(res_frame.astype(np.uint8),(x2-x1,y2-y1))
                 except:
                     continue
-                mask = self.mask_list_cycle[idx]
-                mask_crop_box = self.mask_coords_list_cycle[idx]
+                combine_frame = self.frame_list_cycle[idx].copy()
                 #combine_frame = get_image(ori_frame,res_frame,bbox)
                 #t=time.perf_counter()
-                combine_frame = get_image_blending(ori_frame,res_frame,bbox,mask,mask_crop_box)
+                blend_face(combine_frame,res_frame,bbox,self.alpha_list_cycle[idx])
                 #print('blending time:',time.perf_counter()-t)
 
             image = combine_frame #(outputs['image'] * 255).astype(np.uint8)
@@ -330,9 +356,13 @@ class MuseReal(BaseReal):
         process_thread.start()
 
         self.render_event.set() #start infer process render
-        Thread(target=inference, args=(self.render_event,self.batch_size,self.input_latent_list_cycle,
+        server = None
+        if self.opt.batch_server:
+            server = get_batch_server(self.unet,partial(unet_decode,self.vae,self.unet,self.timesteps),
+                                      self.opt.batch_server_max,self.opt.batch_server_wait/1000,'musetalk')
+        Thread(target=inference, args=(self.render_event,self.batch_size,self.latent_bank,
                                            self.asr.feat_queue,self.asr.output_queue,self.res_frame_queue,
-                                           self.vae, self.unet, self.pe,self.timesteps)).start() #mp.Process
+                                           self.vae, self.unet, self.pe,self.timesteps,server,self.slo,not self.opt.no_pipeline,self.opt.decimate)).start() #mp.Process
         count=0
         totaltime=0
         _starttime=time.perf_counter()
@@ -349,6 +379,8 @@ class MuseReal(BaseReal):
             #     print(f"------actual avg infer fps:{count/totaltime:.4f}")
             #     count=0
             #     totaltime=0
+            if self.slo is not None:
+                self.slo.report_queue(video_track._queue.qsize())
             if video_track._queue.qsize()>=1.5*self.opt.batch_size:
                 logger.debug('sleep qsize=%d',video_track._queue.qsize())
                 time.sleep(0.04*video_track._queue.qsize()*0.8)
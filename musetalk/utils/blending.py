@@ -122,4 +122,33 @@ def get_image_blending(image,face,face_box,mask_array,crop_box):
     body[y_s:y_e, x_s:x_e] = cv2.blendLinear(face_large,body[y_s:y_e, x_s:x_e],mask_image,1-mask_image)
 
     #body.paste(face_large, crop_box[:2], mask_image)
-    return body
\ No newline at end of file
+    return body
+
+def prepare_blend_alpha(mask_array,face_box,crop_box,fixed_point=False):
+    """
+    alpha map used by blend_face, computed once per avatar frame.
+    outside face_box get_image_blending blends the frame with itself,
+    so only the face_box part of the mask is kept.
+    float: [2,h,w] float32 (alpha, 1-alpha) for cv2.blendLinear
+    fixed_point: [h,w,1] uint8, alpha*255
+    """
+    x, y, x1, y1 = face_box
+    x_s, y_s, x_e, y_e = crop_box
+    if mask_array.ndim == 3:
+        mask_array = cv2.cvtColor(np.ascontiguousarray(mask_array),cv2.COLOR_BGR2GRAY)
+    mask_image = mask_array[y-y_s:y1-y_s, x-x_s:x1-x_s]
+    if fixed_point:
+        return np.ascontiguousarray(mask_image[:,:,np.newaxis])
+    mask_image = (mask_image/255).astype(np.float32)
+    return np.ascontiguousarray(np.stack([mask_image,1-mask_image]))
+
+def blend_face(frame,face,face_box,alpha):
+    """blend face into frame[face_box] in place with a prepare_blend_alpha map"""
+    x, y, x1, y1 = face_box
+    body = frame[y:y1, x:x1]
+    if alpha.dtype == np.uint8:
+        blended = face.astype(np.uint16)*alpha + body.astype(np.uint16)*(255-alpha) + 127
+        body[:] = blended // 255
+    else:
+        body[:] = cv2.blendLinear(face,body,alpha[0],alpha[1])
+    return frame
\ No newline at end of file
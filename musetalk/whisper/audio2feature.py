@@ -1,17 +1,95 @@
 import os
 from .whisper import load_model
+from .whisper.audio import N_FFT, N_FRAMES, HOP_LENGTH, log_mel_spectrogram, mel_filters, pad_or_trim
 import soundfile as sf
 import numpy as np
+import torch
 import time
 import sys
+from logger import logger
 sys.path.append("..")
 
+class LogMelStream():
+    """
+    whisper log-mel of the sliding asr window of one session. the log10 mel columns
+    are cached by their sample position in the stream, so only the columns of new
+    audio are transformed. the window shifts by multiples of 640 samples, a multiple
+    of the hop, so every column of the overlap is found again
+    """
+    def __init__(self):
+        self.cols = {}
+        self.window = torch.hann_window(N_FFT)
+        self.filters = mel_filters('cpu')
+
+    def __log10_mel(self, frames_audio):
+        stft = torch.stft(frames_audio, N_FFT, HOP_LENGTH, window=self.window, center=False, return_complex=True)
+        mel_spec = self.filters @ (stft.abs() ** 2)
+        return torch.clamp(mel_spec, min=1e-10).log10()
+
+    def log_mel(self, audio, start):
+        """same as log_mel_spectrogram(audio), audio begins at sample start of the stream"""
+        audio = torch.from_numpy(audio) if not torch.is_tensor(audio) else audio
+        n = len(audio) // HOP_LENGTH #log_mel_spectrogram drops the last stft column
+        pad = N_FFT // 2
+        padded = torch.nn.functional.pad(audio[None, None], (pad, pad), mode='reflect')[0, 0] #as torch.stft center=True
+        # columns touching the reflect padding depend on the window edge, they are not cached
+        first = -(-pad // HOP_LENGTH)
+        last = (len(audio) - pad) // HOP_LENGTH
+        self.cols = {p: c for p, c in self.cols.items() if p >= start}
+
+        cols = [self.cols.get(start + j*HOP_LENGTH) if first <= j <= last else None for j in range(n)]
+        j = 0
+        while j < n: #transform runs of missing columns at once
+            if cols[j] is not None:
+                j += 1
+                continue
+            k = j
+            while k+1 < n and cols[k+1] is None:
+                k += 1
+            log_spec = self.__log10_mel(padded[j*HOP_LENGTH : k*HOP_LENGTH + N_FFT])
+            for i in range(j, k+1):
+                cols[i] = log_spec[:, i-j]
+                if first <= i <= last:
+                    self.cols[start + i*HOP_LENGTH] = cols[i]
+            j = k+1
+
+        log_spec = torch.stack(cols, dim=1)
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        return (log_spec + 4.0) / 4.0
+
 class Audio2Feature():
     def __init__(self, 
                  whisper_model_type="tiny",
                  model_path="./models/whisper/tiny.pt"):
         self.whisper_model_type = whisper_model_type
         self.model = load_model(model_path) #
+        self.window = 0 #mel frames of the short encoder window, 0: 30s window of transcribe
+
+    def set_window(self, seconds, calib_audio=None, input_len=16000, min_cos=0.98):
+        """
+        run the encoder of audio2feat_window on a window of seconds. with calib_audio the
+        features of its input_len long slices are checked against audio2feat first, the
+        window stays off when their cosine similarity is below min_cos
+        """
+        frames = min(int(np.ceil(seconds*100/2))*2, 3000) #even, the encoder halves it
+        if frames <= 0:
+            self.window = 0
+            return
+        if input_len//HOP_LENGTH > frames:
+            logger.warning(f'whisper window {seconds}s is shorter than the asr input {input_len/16000:.2f}s, it would never be used')
+        if calib_audio is not None:
+            self.window = 0
+            slices = [calib_audio[i:i+input_len] for i in range(0, len(calib_audio)-input_len+1, input_len//2)]
+            ref = np.concatenate([self.audio2feat(x) for x in slices])
+            self.window = frames
+            out = np.concatenate([self.audio2feat_window(x) for x in slices])
+            cos = feature_cosine(ref, out).min()
+            if cos < min_cos:
+                logger.warning(f'whisper window {seconds}s feature cosine {cos:.4f} < {min_cos}, keeps the 30s window')
+                self.window = 0
+                return
+            logger.info(f'whisper runs on a {seconds}s window, feature cosine to the 30s window {cos:.4f}')
+        self.window = frames
 
     def get_sliced_feature(self,
                            feature_array, 
@@ -80,21 +158,16 @@ class Audio2Feature():
     
 
     def feature2chunks(self,feature_array,fps,batch_size,audio_feat_length = [2,2],start=0):
-        whisper_chunks = []
-        whisper_idx_multiplier = 50./fps 
-        i = 0
+        """
+        get_sliced_feature of the video frames start..start+batch_size as one clamped
+        gather, (batch_size, (audio_feat_length[0]+audio_feat_length[1]+1)*2*5, 384)
+        """
+        feature_array = np.asarray(feature_array)
         #print(f"video in {fps} FPS, audio idx in 50FPS")
-        for _ in range(batch_size):
-            # start_idx = int(i * whisper_idx_multiplier)
-            # if start_idx>=len(feature_array):
-            #     break
-            selected_feature,selected_idx = self.get_sliced_feature(feature_array= feature_array,vid_idx = i+start,audio_feat_length=audio_feat_length,fps=fps)
-            #print(f"i:{i},selected_idx {selected_idx}")
-            whisper_chunks.append(selected_feature)
-            i += 1
-            
-
-        return whisper_chunks
+        center_idx = ((np.arange(batch_size) + start)*50/fps).astype(np.int64)
+        offsets = np.arange(-audio_feat_length[0]*2, (audio_feat_length[1]+1)*2)
+        idx = np.clip(center_idx[:, None] + offsets, 0, len(feature_array)-1)
+        return feature_array[idx].reshape(batch_size, -1, 384)
 
     def audio2feat(self,audio_path):
         # get the sample rate of the audio
@@ -111,20 +184,91 @@ class Audio2Feature():
         concatenated_array = np.concatenate(embed_list, axis=0)
         return concatenated_array
 
+    def audio2feat_window(self, audio, mel_stream=None, start=None, encoder=None):
+        """
+        audio2feat of a short audio, same (T,5,384) layout. the encoder runs on the
+        window set by set_window instead of the 30s that transcribe pads every input to
+        (on those 30s when no window is set).
+        mel_stream/start: LogMelStream of the session and the position of audio in it
+        encoder: encoder(segment) -> embeddings, e.g. the BatchServer shared by all sessions
+        """
+        n = len(audio) // HOP_LENGTH
+        frames = self.window or N_FRAMES
+        if n > frames: #e.g. a lookahead batch
+            return self.audio2feat(audio)
+        if mel_stream is not None and start is not None:
+            mel = mel_stream.log_mel(audio, start)
+        else:
+            mel = log_mel_spectrogram(audio)
+        device = self.model.device
+        dtype = torch.float16 if device.type == 'cuda' else torch.float32 #as transcribe
+        segment = pad_or_trim(mel, frames).to(device).to(dtype).unsqueeze(0)
+        if encoder is not None:
+            embeddings = encoder(segment)
+        else:
+            with torch.no_grad():
+                _, embeddings = self.model.encoder(segment, include_embeddings=True)
+        embeddings = embeddings.transpose(0,2,1,3).squeeze(0)
+        return embeddings[:n//2]
+
+def encoder_embeddings(audio_processor, segment):
+    """embeddings of the whisper encoder layers for a batch of mel segments, [B,5,frames/2,384]"""
+    return audio_processor.model.encoder(segment, include_embeddings=True)[1]
+
+def feature_cosine(ref, out):
+    """cosine similarity of every audio frame of two (T,5,384) features"""
+    ref = ref.reshape(len(ref), -1).astype(np.float64)
+    out = out.reshape(len(out), -1).astype(np.float64)
+    return (ref*out).sum(1) / np.maximum(np.linalg.norm(ref, axis=1)*np.linalg.norm(out, axis=1), 1e-12)
+
 if __name__ == "__main__":
-    audio_processor = Audio2Feature(model_path="../../models/whisper/whisper_tiny.pt")
-    audio_path = "./test.mp3"
-    array = audio_processor.audio2feat(audio_path)
-    print(array.shape)
-    fps = 25
-    whisper_idx_multiplier = 50./fps 
-
-    i = 0
-    print(f"video in {fps} FPS, audio idx in 50FPS")
-    while 1:
-        start_idx = int(i * whisper_idx_multiplier)
-        selected_feature,selected_idx = audio_processor.get_sliced_feature(feature_array= array,vid_idx = i,audio_feat_length=[2,2],fps=fps)
-        print(f"video idx {i},\t audio idx {selected_idx},\t shape {selected_feature.shape}")
-        i += 1
-        if start_idx>len(array):
-            break
+    # parity and speed of the short window against audio2feat, on 1s asr windows:
+    # python -m musetalk.whisper.audio2feature --audio speech.wav --window 2
+    import argparse
+    from quantize import calib_speech
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='./models/whisper/tiny.pt')
+    parser.add_argument('--audio', type=str, default='', help="wav file, default a synthetic voiced signal")
+    parser.add_argument('--window', type=float, nargs='+', default=[1.5, 2, 4, 8])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('-l', type=int, default=10)
+    parser.add_argument('-r', type=int, default=10)
+    parser.add_argument('--bench_chunks', action='store_true', help="only time feature2chunks against the per frame get_sliced_feature loop")
+    args = parser.parse_args()
+
+    if args.bench_chunks: #no model needed
+        audio_processor = Audio2Feature.__new__(Audio2Feature)
+        feats = np.random.rand(2*(args.l+2*128+args.r), 5, 384).astype(np.float32)
+        for batch_size in [1, 4, 8, 16, 32, 64, 128]:
+            t = time.perf_counter()
+            for _ in range(100):
+                ref = [audio_processor.get_sliced_feature(feats, i+args.l/2, fps=25)[0] for i in range(batch_size)]
+            loop_us = (time.perf_counter()-t)*1e4
+            t = time.perf_counter()
+            for _ in range(100):
+                out = audio_processor.feature2chunks(feats, 25, batch_size, start=args.l/2)
+            gather_us = (time.perf_counter()-t)*1e4
+            assert np.array_equal(np.stack(ref), out)
+            print(f"batch {batch_size:4d}: loop {loop_us:8.1f}us gather {gather_us:7.1f}us ({loop_us/gather_us:.1f}x)")
+        sys.exit()
+
+    audio_processor = Audio2Feature(model_path=args.model_path)
+    wav = calib_speech(args.audio or None, seconds=8)
+    input_len = (args.l+2*args.batch_size+args.r)*320 #audio of one asr step
+    step = 2*args.batch_size*320 #the asr window moves by the audio of batch_size video frames
+    slices = [(i, wav[i:i+input_len]) for i in range(0, len(wav)-input_len+1, step)]
+
+    t = time.perf_counter()
+    ref = [audio_processor.audio2feat(x) for _, x in slices]
+    full_ms = (time.perf_counter()-t)*1000/len(slices)
+    print(f"30s window: {full_ms:.1f}ms per step, features {ref[0].shape}")
+    for window in args.window:
+        audio_processor.set_window(window)
+        mel_stream = LogMelStream()
+        t = time.perf_counter()
+        out = [audio_processor.audio2feat_window(x, mel_stream, i) for i, x in slices]
+        ms = (time.perf_counter()-t)*1000/len(slices)
+        mel_err = max((mel_stream.log_mel(x, i) - log_mel_spectrogram(x)).abs().max().item() for i, x in slices)
+        cos = feature_cosine(np.concatenate(ref), np.concatenate(out))
+        print(f"{window}s window: {ms:.1f}ms per step ({full_ms/ms:.1f}x), features {out[0].shape}, "
+              f"cosine min {cos.min():.4f} mean {cos.mean():.4f}, log-mel max diff {mel_err:.2e}")
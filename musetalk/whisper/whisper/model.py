@@ -151,8 +151,9 @@ class AudioEncoder(nn.Module):
         x = F.gelu(self.conv2(x))
         x = x.permute(0, 2, 1)
 
-        assert x.shape[1:] == self.positional_embedding.shape, "incorrect audio shape"
-        x = (x + self.positional_embedding).to(x.dtype)
+        # shorter inputs than n_ctx (streaming window) use the leading positions only
+        assert x.shape[1] <= self.positional_embedding.shape[0] and x.shape[2] == self.positional_embedding.shape[1], "incorrect audio shape"
+        x = (x + self.positional_embedding[:x.shape[1]]).to(x.dtype)
 
         if include_embeddings:
             embeddings = [x.cpu().detach().numpy()]
@@ -24,7 +24,14 @@ import queue
 from queue import Queue
 #from collections import deque
 
+from functools import partial
 from baseasr import BaseASR
+from inferserver import get_batch_server
+
+def audio_forward(model, hubert, input_values):
+    """features of a batch of windows, [B, T, audio_dim]"""
+    result = model(input_values)
+    return result.last_hidden_state if hubert else result.logits
 
 class NerfASR(BaseASR):
     def __init__(self, opt, parent, audio_processor,audio_model):
@@ -60,6 +67,9 @@ class NerfASR(BaseASR):
         #     self.model = AutoModelForCTC.from_pretrained(opt.asr_model).to(self.device)
         self.processor = audio_processor
         self.model = audio_model
+        self.forward = partial(audio_forward, audio_model, 'hubert' in self.opt.asr_model)
+        if getattr(opt,'asr_batch_server',False): #one forward for the windows of all sessions
+            self.forward = get_batch_server(audio_model, self.forward, 0, opt.batch_server_wait/1000, 'asr')
 
         # the extracted features 
         # use a loop queue to efficiently record endless features: [f--t---][-------][-------]
@@ -192,11 +202,7 @@ class NerfASR(BaseASR):
         inputs = self.processor(frame, sampling_rate=self.sample_rate, return_tensors="pt", padding=True)
         
         with torch.no_grad():
-            result = self.model(inputs.input_values.to(self.device))
-            if 'hubert' in self.opt.asr_model:
-                logits = result.last_hidden_state # [B=1, T=pts//320, hid=1024]
-            else:
-                logits = result.logits # [1, N - 1, 32]
+            logits = self.forward(inputs.input_values.to(self.device)) # [1, T=pts//320, audio_dim]
         #print('logits.shape:',logits.shape)
         
         # cut off stride
@@ -31,6 +31,7 @@ from nerfasr import NerfASR
 import asyncio
 from av import AudioFrame, VideoFrame
 from basereal import BaseReal
+from avatarstore import open_bundle,read_imgs_array
 
 #from imgcache import ImgCache
 from ernerf.nerf_triplane.provider import NeRFDataset_Test
@@ -39,15 +40,6 @@ from ernerf.nerf_triplane.network import NeRFNetwork
 from transformers import AutoModelForCTC, AutoProcessor, Wav2Vec2Processor, HubertModel
 
 from logger import logger
-from tqdm import tqdm
-def read_imgs(img_list):
-    frames = []
-    logger.info('reading images...')
-    for img_path in tqdm(img_list):
-        frame = cv2.imread(img_path)
-        frames.append(frame)
-    return frames
-
 def load_model(opt):
     # assert test mode
     opt.test = True
@@ -101,10 +93,13 @@ def load_model(opt):
 def load_avatar(opt):
     fullbody_list_cycle = None
     if opt.fullbody:
+        bundle = open_bundle(opt.fullbody_img.rstrip('/\\') + '.bundle')
+        if bundle is not None:
+            return bundle.images('imgs')
         input_img_list = glob.glob(os.path.join(opt.fullbody_img, '*.[jpJP][pnPN]*[gG]'))
         input_img_list = sorted(input_img_list, key=lambda x: int(os.path.splitext(os.path.basename(x))[0]))
         #print('input_img_list:',input_img_list)
-        fullbody_list_cycle = read_imgs(input_img_list) #[:frame_total_num]
+        fullbody_list_cycle = read_imgs_array(input_img_list) #[:frame_total_num]
         #self.imagecache = ImgCache(frame_total_num,self.opt.fullbody_img,1000)
     return fullbody_list_cycle
 
@@ -199,6 +194,7 @@ class NeRFReal(BaseReal):
 
     def __del__(self):
         logger.info(f'nerfreal({self.sessionid}) delete')    
+        super().__del__()
 
     def __enter__(self):
         return self
@@ -0,0 +1,221 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# --quantize for cpu nodes
+#   int8  lip-sync models (wav2lip, ultralight unet): FX static int8, calibrated on
+#         the avatar's own face frames. parts FX can not trace (shape dependent
+#         python in forward) stay float, their traceable children are quantized.
+#         audio encoders (whisper, hubert): dynamic int8 of the Linear layers
+#   bf16  autocast to bfloat16, where the cpu supports it
+# every quantized model is checked against the float model on the calibration
+# data, lip-sync models by the PSNR of the mouth half of the output, audio encoders
+# by the cosine similarity of the features. a model that fails keeps running float.
+
+import copy
+
+import numpy as np
+import torch
+from torch import nn
+
+from logger import logger
+
+QUANT_MODES = ['none', 'int8', 'bf16']
+
+def bf16_supported():
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except Exception:
+        return False
+
+class Bf16Model(nn.Module):
+    """runs model under cpu bf16 autocast, the output is float32 again"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            out = self.model(*inputs)
+        return out.float()
+
+def _to_float(out):
+    if isinstance(out, torch.Tensor):
+        return out.float() if out.dtype == torch.bfloat16 else out
+    if isinstance(out, dict): #transformers ModelOutput
+        for k in list(out.keys()):
+            out[k] = _to_float(out[k])
+        return out
+    if type(out) is tuple:
+        return tuple(_to_float(o) for o in out)
+    return out
+
+def autocast_children(model):
+    """
+    bf16 copy of an audio encoder. its children run under autocast, so methods
+    other than forward (whisper transcribe) keep working, outputs are float32 again
+    """
+    model = copy.deepcopy(model)
+    for child in model.children():
+        def forward(*args, _forward=child.forward, **kwargs):
+            with torch.autocast('cpu', dtype=torch.bfloat16):
+                return _to_float(_forward(*args, **kwargs))
+        child.forward = forward
+    return model
+
+def _has_weights(module):
+    return any(isinstance(m, (nn.Conv2d, nn.ConvTranspose2d, nn.Linear)) for m in module.modules())
+
+def _capture_inputs(model, example_inputs):
+    """positional inputs of every submodule when running example_inputs, by module name"""
+    inputs, hooks = {}, []
+    for name, module in model.named_modules():
+        def hook(module, args, name=name):
+            inputs.setdefault(name, args)
+        hooks.append(module.register_forward_pre_hook(hook))
+    try:
+        with torch.no_grad():
+            model(*example_inputs)
+    finally:
+        for h in hooks:
+            h.remove()
+    return inputs
+
+def _prepare(module, name, inputs, qconfig_mapping, prepared):
+    from torch.ao.quantization.quantize_fx import prepare_fx
+    if name in inputs and _has_weights(module):
+        try:
+            module = prepare_fx(module, qconfig_mapping, inputs[name])
+            prepared.append(module)
+            return module
+        except Exception: #not traceable, try its children
+            pass
+    for child_name, child in module.named_children():
+        setattr(module, child_name, _prepare(child, f'{name}.{child_name}' if name else child_name,
+                                             inputs, qconfig_mapping, prepared))
+    return module
+
+def _convert(module, prepared):
+    from torch.ao.quantization.quantize_fx import convert_fx
+    if any(module is p for p in prepared):
+        return convert_fx(module)
+    for child_name, child in module.named_children():
+        setattr(module, child_name, _convert(child, prepared))
+    return module
+
+def quantize_int8_static(model, calib_batches):
+    """static int8 copy of model, observers calibrated on calib_batches (tuples of model inputs)"""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    torch.backends.quantized.engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+    model = copy.deepcopy(model).eval()
+    inputs = _capture_inputs(model, calib_batches[0])
+    prepared = []
+    model = _prepare(model, '', inputs, get_default_qconfig_mapping(torch.backends.quantized.engine), prepared)
+    if not prepared:
+        raise RuntimeError('no traceable submodule to quantize')
+    with torch.no_grad():
+        for batch in calib_batches:
+            model(*batch)
+    return _convert(model, prepared)
+
+def quantize_int8_dynamic(model):
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+
+def mouth_psnr(ref, out):
+    """psnr of the lower (mouth) half of [B,3,H,W] outputs in 0..1"""
+    h = ref.shape[2]
+    mse = torch.mean((ref[:, :, h//2:].float() - out[:, :, h//2:].float())**2).item()
+    return 10*np.log10(1.0/max(mse, 1e-10))
+
+def quantize_lipsync(model, calib_batches, mode='int8', name='model', min_psnr=30.0):
+    """quantized model, or model itself when the mode is unavailable or the check fails"""
+    if mode == 'none':
+        return model
+    if next(model.parameters()).device.type != 'cpu':
+        logger.warning(f'--quantize {mode} is for cpu inference, {name} stays float')
+        return model
+    if mode == 'bf16' and not bf16_supported():
+        logger.warning(f'cpu has no bf16 support, {name} stays float')
+        return model
+    try:
+        quantized = quantize_int8_static(model, calib_batches) if mode == 'int8' else Bf16Model(model).eval()
+        with torch.no_grad():
+            psnr = min(mouth_psnr(model(*batch), quantized(*batch)) for batch in calib_batches)
+    except Exception:
+        logger.exception(f'quantize {name} to {mode} failed, stays float')
+        return model
+    if psnr < min_psnr:
+        logger.warning(f'{name} {mode} mouth psnr {psnr:.1f}dB < {min_psnr}dB, stays float')
+        return model
+    logger.info(f'{name} runs {mode}, mouth psnr to float {psnr:.1f}dB')
+    return quantized
+
+def quantize_audio_encoder(owner, run, mode='int8', name='audio', min_cos=0.98):
+    """
+    swap owner.model for its quantized version, run() extracts features of the
+    calibration speech with owner.model. owner.model is kept when the check fails
+    """
+    if mode == 'none':
+        return
+    model = owner.model
+    if next(model.parameters()).device.type != 'cpu':
+        logger.warning(f'--quantize {mode} is for cpu inference, {name} stays float')
+        return
+    if mode == 'bf16' and not bf16_supported():
+        logger.warning(f'cpu has no bf16 support, {name} stays float')
+        return
+    try:
+        with torch.no_grad():
+            ref = torch.as_tensor(np.asarray(run())).float().flatten()
+            owner.model = quantize_int8_dynamic(model) if mode == 'int8' else autocast_children(model)
+            out = torch.as_tensor(np.asarray(run())).float().flatten()
+        cos = torch.nn.functional.cosine_similarity(ref, out, dim=0).item()
+    except Exception:
+        logger.exception(f'quantize {name} to {mode} failed, stays float')
+        owner.model = model
+        return
+    if cos < min_cos:
+        logger.warning(f'{name} {mode} feature cosine {cos:.4f} < {min_cos}, stays float')
+        owner.model = model
+        return
+    logger.info(f'{name} runs {mode}, feature cosine to float {cos:.4f}')
+
+def calib_speech(path=None, seconds=4, sr=16000):
+    """
+    16k mono audio to calibrate with: the wav at path, or a synthetic voiced signal
+    (harmonics of a gliding pitch, syllable rate envelope, some noise)
+    """
+    if path:
+        import resampy
+        import soundfile as sf
+        wav, wav_sr = sf.read(path, dtype='float32')
+        if wav.ndim > 1:
+            wav = wav[:, 0]
+        if wav_sr != sr:
+            wav = resampy.resample(wav, wav_sr, sr)
+        return wav[:seconds*sr].astype(np.float32)
+    rng = np.random.default_rng(0)
+    t = np.arange(seconds*sr)/sr
+    f0 = 150 + 50*np.sin(2*np.pi*0.5*t)
+    phase = 2*np.pi*np.cumsum(f0)/sr
+    voiced = sum(np.sin(k*phase)/k for k in range(1, 20))
+    envelope = np.clip(np.sin(2*np.pi*4*t), 0, None)
+    wav = 0.3*envelope*voiced + 0.01*rng.standard_normal(len(t))
+    return (wav/np.abs(wav).max()*0.5).astype(np.float32)
+
+def calib_rows(length, n):
+    """n avatar frame indices spread over the whole cycle"""
+    return np.linspace(0, length-1, min(n, length)).astype(np.int64)
@@ -0,0 +1,114 @@
+###############################################################################
+#  Copyright (C) 2024 LiveTalking@lipku https://github.com/lipku/LiveTalking
+#  email: lipku@foxmail.com
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# real-time SLO controller
+# one per session. inference() reports how fast the model runs, render() reports
+# how many video frames are queued for sending. when the session cannot hold the
+# target fps it steps down through cheaper modes, and steps back up after a longer
+# period with headroom (hysteresis, so it does not flap):
+#   NORMAL     full quality
+#   REUSE      run the model on every other frame, the frames between blend the neighbouring mouths
+#   IDLE       no model, speaking frames show the idle avatar frame, audio stays in sync
+
+import time
+from threading import Lock
+
+from logger import logger
+
+NORMAL = 0
+REUSE = 1
+IDLE = 2
+LEVEL_NAMES = ['normal', 'reuse', 'idle']
+
+# share of the model work a level still does, used to predict the fps one level up
+_MODEL_COST = [1.0, 0.5, 0.0]
+
+class SLOController:
+    def __init__(self, target_fps=25, down_hold=2.0, up_hold=5.0, headroom=1.2, sessionid=0):
+        self.target_fps = target_fps
+        self.down_hold = down_hold #seconds overloaded before stepping down
+        self.up_hold = up_hold #seconds with headroom before stepping up
+        self.headroom = headroom
+        self.sessionid = sessionid
+
+        self.level = NORMAL
+        self.lock = Lock()
+        self.model_fps = None #frames per second of model time, ema
+        self.queue_depth = None #queued video frames, ema
+        self.overload_since = None
+        self.headroom_since = None
+
+    def report_infer(self, model_frames, seconds):
+        """model_frames frames went through the model in seconds (wall time of the batch)"""
+        if model_frames <= 0 or seconds <= 0:
+            return
+        fps = model_frames / seconds
+        with self.lock:
+            self.model_fps = fps if self.model_fps is None else 0.8*self.model_fps + 0.2*fps
+            self.__update()
+
+    def report_queue(self, depth):
+        with self.lock:
+            self.queue_depth = depth if self.queue_depth is None else 0.9*self.queue_depth + 0.1*depth
+            self.__update()
+
+    def __effective_fps(self, level):
+        """output fps the model could sustain at level"""
+        if self.model_fps is None:
+            return None
+        cost = _MODEL_COST[level]
+        return float('inf') if cost == 0 else self.model_fps / cost
+
+    def __update(self):
+        now = time.perf_counter()
+        # the sender waiting for frames means the session produces less than real time,
+        # whether the model or the compositing/encoding is the slow part
+        overloaded = self.queue_depth is not None and self.queue_depth < 1
+
+        if overloaded:
+            self.headroom_since = None
+            if self.overload_since is None:
+                self.overload_since = now
+            elif now - self.overload_since >= self.down_hold and self.level < IDLE:
+                self.__set_level(self.level + 1)
+            return
+        self.overload_since = None
+
+        if self.level == NORMAL:
+            return
+        up_fps = self.__effective_fps(self.level - 1)
+        has_headroom = up_fps is None or up_fps >= self.target_fps*self.headroom
+        if not has_headroom:
+            self.headroom_since = None
+        elif self.headroom_since is None:
+            self.headroom_since = now
+        elif now - self.headroom_since >= self.up_hold:
+            self.__set_level(self.level - 1)
+
+    def __set_level(self, level):
+        logger.info(f'session {self.sessionid} slo level {LEVEL_NAMES[self.level]} -> {LEVEL_NAMES[level]}, '
+                    f'model fps {self.model_fps or 0:.1f}, video queue {self.queue_depth or 0:.1f}')
+        self.level = level
+        if level == IDLE:
+            self.model_fps = None #no measurements at IDLE, probe REUSE again once the queue is healthy
+        self.overload_since = None
+        self.headroom_since = None
+
+def create_slo(opt):
+    if not getattr(opt, 'slo', False):
+        return None
+    return SLOController(opt.slo_fps, sessionid=opt.sessionid)
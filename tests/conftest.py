@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules are imported from the repository root, like app.py does
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,75 @@
+# AvatarRegistry: sessions starting together share one load and one entry
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+from avatarregistry import AvatarRegistry, valid_avatar_id
+
+class Closable:
+    def __init__(self):
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+def slow_loader(loads):
+    def loader(avatar_id):
+        loads.append(avatar_id)
+        time.sleep(0.2)
+        return (np.zeros(1000, np.uint8), Closable())
+    return loader
+
+def test_concurrent_acquire_loads_once():
+    loads = []
+    registry = AvatarRegistry(slow_loader(loads))
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.acquire('a'))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert loads == ['a']
+    assert all(r is results[0] for r in results)
+    assert registry.avatars['a'][1] == 4
+
+def test_evicts_only_unused_and_closes_them():
+    loads = []
+    registry = AvatarRegistry(slow_loader(loads), max_bytes=1500)
+    a = registry.acquire('a')
+    b = registry.acquire('b') #over budget, but a is in use
+    assert 'a' in registry.avatars and not a[1].closed
+    registry.release('a')
+    registry.release('b') #both idle, the least recently used goes
+    assert 'a' not in registry.avatars and a[1].closed
+    assert 'b' in registry.avatars and not b[1].closed
+
+def test_loader_error_wakes_waiting_sessions():
+    calls = []
+    def loader(avatar_id):
+        calls.append(avatar_id)
+        time.sleep(0.1)
+        if len(calls) == 1:
+            raise IOError('broken avatar')
+        return (np.zeros(10, np.uint8),)
+    registry = AvatarRegistry(loader)
+    errors, results = [], []
+    def acquire():
+        try:
+            results.append(registry.acquire('a'))
+        except IOError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=acquire) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    assert len(errors) == 1 and len(results) == 1
+    assert registry.avatars['a'][1] == 1 and not registry.loading
+
+def test_valid_avatar_id(tmp_path):
+    (tmp_path / 'avator_1').mkdir()
+    assert valid_avatar_id('avator_1', str(tmp_path))
+    for avatar_id in ['', '.', '..', '../avator_1', 'avator_1/..', '/etc', 'a\\b', 'missing', None, 3]:
+        assert not valid_avatar_id(avatar_id, str(tmp_path))
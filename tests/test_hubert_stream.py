@@ -0,0 +1,46 @@
+# --hubert_context: HubertStream reuses the features of earlier steps, whose windows were
+# normalized with other statistics. check the error stays bounded over a long stream
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+audio2feature = pytest.importorskip('ultralight.audio2feature')
+from quantize import calib_speech
+
+L, R, BATCH_SIZE = 10, 10, 16 #app.py defaults
+CONTEXT = 8 #transformer context frames, below (L+R)/2 so frames are reused
+MIN_COS = 0.98 #set_context encodes the whole window below this
+
+@pytest.fixture(scope='module')
+def audio_processor():
+    try:
+        return audio2feature.Audio2Feature()
+    except OSError as e: #weights not downloaded and no network
+        pytest.skip(f'hubert weights not available: {e}')
+
+def test_stream_features_do_not_drift(audio_processor):
+    clip = calib_speech(seconds=60)
+    input_len = (L+2*BATCH_SIZE+R)*320
+    step = 2*BATCH_SIZE*320
+    audio_processor.context = CONTEXT
+    stream = audio2feature.HubertStream(audio_processor)
+    cos = []
+    for n, i in enumerate(range(0, len(clip)-input_len+1, step)):
+        x = clip[i:i+input_len]
+        ref = audio_processor.get_hubert_from_16k_speech(x).float()
+        reused, encoded = stream.reused, stream.encoded
+        out = stream.features(x, i).float()
+        assert out.shape == ref.shape
+        T = len(ref)
+        if n == 0:
+            assert (stream.reused, stream.encoded) == (0, T)
+        else: #the frames with CONTEXT frames of right context in the last window are final
+            assert stream.reused - reused == T - 2*BATCH_SIZE - CONTEXT
+            assert stream.encoded - encoded == 2*BATCH_SIZE + 2*CONTEXT
+        cos.append(torch.nn.functional.cosine_similarity(ref, out, dim=1).min().item())
+    audio_processor.context = 0
+    cos = np.array(cos)
+    assert cos.min() >= MIN_COS
+    # the reused frames would drift away from the whole window encoding over time
+    quarter = len(cos)//4
+    assert cos[-quarter:].mean() >= cos[:quarter].mean() - 0.005
@@ -0,0 +1,46 @@
+# LipASR with StreamingMel against melspectrogram of every asr window
+import queue
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('librosa')
+from wav2lip import audio
+from lipasr import LipASR
+
+def window_chunks(inputs, starts):
+    mel = audio.melspectrogram(inputs)
+    return [mel[:, s:s+16] for s in starts]
+
+@pytest.mark.parametrize('batch_size', [16, 5, 10, 7])
+def test_chunks_match_melspectrogram(batch_size):
+    opt = SimpleNamespace(fps=50, batch_size=batch_size, l=10, r=10)
+    asr = LipASR(opt)
+    asr.feat_queue = queue.Queue() #no inference thread takes the batches
+    asr.warm_up()
+    windows = []
+    extract_chunks = asr.extract_chunks
+    def record(inputs, batch_size, start=None, silent=()):
+        if start is not None:
+            windows.append((inputs, asr.mel_starts(batch_size, len(inputs))))
+        return extract_chunks(inputs, batch_size, start, silent)
+    asr.extract_chunks = record
+
+    rng = np.random.default_rng(0)
+    frames = 0
+    for step in range(30):
+        if step % 7 != 3: #speech with silent gaps inside and between the batches
+            for _ in range(rng.integers(0, 3*batch_size)):
+                asr.put_audio_frame((0.3*rng.standard_normal(asr.chunk)).astype(np.float32))
+        n = len(windows)
+        asr.run_step()
+        chunks = []
+        while not asr.feat_queue.empty():
+            chunks += list(asr.feat_queue.get())
+        if len(windows) > n:
+            for got, expected in zip(chunks, window_chunks(*windows[-1])):
+                np.testing.assert_allclose(got, expected, rtol=0, atol=1e-9)
+                frames += 1
+    assert frames > 10*batch_size
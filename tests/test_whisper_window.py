@@ -0,0 +1,42 @@
+# --whisper_window: features of the short encoder window against the 30s window of transcribe
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('torch')
+audio2feature = pytest.importorskip('musetalk.whisper.audio2feature')
+from quantize import calib_speech
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_PATH = os.path.join(ROOT, 'models/whisper/tiny.pt')
+L, R, BATCH_SIZE = 10, 10, 16 #app.py defaults
+MIN_COS = 0.98 #set_window keeps the 30s window below this
+
+pytestmark = pytest.mark.skipif(not os.path.exists(MODEL_PATH), reason='whisper tiny weights not downloaded')
+
+@pytest.fixture(scope='module')
+def audio_processor():
+    return audio2feature.Audio2Feature(model_path=MODEL_PATH)
+
+@pytest.fixture(scope='module')
+def clip():
+    return calib_speech(seconds=8) #deterministic voiced signal
+
+def asr_windows(clip):
+    """the windows of consecutive asr steps and their position in the stream"""
+    input_len = (L+2*BATCH_SIZE+R)*320
+    step = 2*BATCH_SIZE*320
+    return [(i, clip[i:i+input_len]) for i in range(0, len(clip)-input_len+1, step)]
+
+@pytest.mark.parametrize('seconds', [1.0, 2.0])
+def test_window_features_match_30s_window(audio_processor, clip, seconds):
+    windows = asr_windows(clip)
+    audio_processor.set_window(0)
+    ref = np.concatenate([audio_processor.audio2feat(x) for _, x in windows])
+    audio_processor.set_window(seconds)
+    mel_stream = audio2feature.LogMelStream()
+    out = np.concatenate([audio_processor.audio2feat_window(x, mel_stream, i) for i, x in windows])
+    audio_processor.set_window(0)
+    assert out.shape == ref.shape
+    assert audio2feature.feature_cosine(ref, out).min() >= MIN_COS
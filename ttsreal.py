@@ -103,6 +103,7 @@ class EdgeTTS(BaseTTS):
         stream = self.__create_bytes_stream(self.input_stream)
         streamlen = stream.shape[0]
         idx=0
+        frames = []
         while streamlen >= self.chunk and self.state==State.RUNNING:
             eventpoint=None
             streamlen -= self.chunk
@@ -110,8 +111,10 @@ class EdgeTTS(BaseTTS):
                 eventpoint={'status':'start','text':text,'msgenvent':textevent}
             elif streamlen<self.chunk:
                 eventpoint={'status':'end','text':text,'msgenvent':textevent}
-            self.parent.put_audio_frame(stream[idx:idx+self.chunk],eventpoint)
+            frames.append((stream[idx:idx+self.chunk],eventpoint))
             idx += self.chunk
+        if self.state==State.RUNNING: #the whole sentence is known, asr can extract it ahead
+            self.parent.put_audio_utterance(frames)
         #if streamlen>0:  #skip last frame(not 20ms)
         #    self.queue.put(stream[idx:])
         self.input_stream.seek(0)
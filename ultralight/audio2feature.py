@@ -1,17 +1,123 @@
 from transformers import Wav2Vec2Processor, HubertModel
 import torch
 import numpy as np
+import time
+from functools import partial
+from logger import logger
 
+KERNEL = 400 #receptive field of the cnn frontend, samples
+STRIDE = 320 #samples per hubert frame
+
+class HubertStream():
+    """
+    hubert features of the sliding asr window of one session, only new audio is encoded:
+      normalisation  zero mean/unit variance like the processor, numpy on the whole window
+      cnn frontend   frame t sees samples [320t, 320t+400) only, projected frames are cached
+                     by stream position, so it runs on the new audio
+      transformer    runs on the frames that are not final yet plus audio_processor.context
+                     frames before them. a frame is final once context frames after it are
+                     in the window, its features are cached then
+    a window starts as the original: every frame is new, so it is encoded as one.
+    a window of T frames moving by S frames reuses T-S-context frames per step and runs the
+    transformer on S+2*context, nothing is reused when 2*context >= T-S
+    """
+    def __init__(self, audio_processor, encoder=None):
+        self.audio_processor = audio_processor
+        self.encoder = encoder #encoder(states) -> last_hidden_state, e.g. a shared BatchServer
+        self.projected = {} #stream frame -> feature projection output
+        self.hidden = {} #stream frame -> last_hidden_state
+        self.reused = 0 #frames taken from self.hidden, summed over the steps
+        self.encoded = 0 #frames the transformer ran on, summed over the steps
+
+    @torch.no_grad()
+    def features(self, speech, start):
+        """same as get_hubert_from_16k_speech(speech), speech begins at sample start of the stream"""
+        audio_processor = self.audio_processor
+        model = audio_processor.model
+        context = audio_processor.context
+        if len(speech) > STRIDE*1000: #a long lookahead utterance, clipped like get_hubert_from_16k_speech
+            return audio_processor.get_hubert_from_16k_speech(speech)
+        T = (len(speech) - (KERNEL-STRIDE)) // STRIDE
+        first = start // STRIDE
+        self.projected = {f: x for f, x in self.projected.items() if f >= first}
+        self.hidden = {f: x for f, x in self.hidden.items() if f >= first}
+
+        t0 = next((t for t in range(T) if first+t not in self.projected), T)
+        if t0 < T:
+            x = speech.astype(np.float32)
+            if audio_processor.do_normalize:
+                x = (x - x.mean()) / np.sqrt(x.var() + 1e-7)
+            x = torch.from_numpy(np.ascontiguousarray(x[t0*STRIDE : (T-1)*STRIDE + KERNEL])).to(audio_processor.device)
+            extract_features = model.feature_extractor(x[None]).transpose(1, 2)
+            projected = model.feature_projection(extract_features)
+            if isinstance(projected, tuple): #wav2vec2 style projection also returns the normed input
+                projected = projected[0]
+            for t in range(t0, T):
+                self.projected[first+t] = projected[0, t-t0]
+
+        hidden = [self.hidden.get(first+t) for t in range(T)]
+        t1 = next((t for t in range(T) if hidden[t] is None), T)
+        self.reused += t1
+        if t1 < T:
+            c0 = max(t1 - context, 0)
+            self.encoded += T - c0
+            states = torch.stack([self.projected[first+t] for t in range(c0, T)])[None]
+            out = (self.encoder or partial(encoder_hidden_state, audio_processor))(states)[0]
+            for t in range(t1, T):
+                hidden[t] = out[t-c0]
+                if t + context < T: #context frames of right context in this window
+                    self.hidden[first+t] = hidden[t]
+        return torch.stack(hidden).cpu()
 
 class Audio2Feature():
     def __init__(self):
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         self.processor = Wav2Vec2Processor.from_pretrained("facebook/hubert-large-ls960-ft")
         self.model = HubertModel.from_pretrained("facebook/hubert-large-ls960-ft").to(self.device)
+        self.do_normalize = getattr(self.processor.feature_extractor, 'do_normalize', True)
+        self.context = 0 #transformer context frames of HubertStream, 0: whole window every step
+
+    def set_context(self, frames, calib_audio=None, input_len=16640, step=10240, min_cos=0.98):
+        """
+        encode asr windows with HubertStream, the transformer sees frames of context.
+        with calib_audio, input_len long windows moving by step are checked against
+        get_hubert_from_16k_speech first, it stays off when the cosine is below min_cos
+        """
+        self.context = 0
+        if frames <= 0:
+            return
+        if self.model.config.feat_extract_norm != 'layer': #group norm spans the whole window
+            logger.warning(f'hubert feature encoder norm {self.model.config.feat_extract_norm} is not frame local, no streaming')
+            return
+        window, moved = (input_len - (KERNEL-STRIDE)) // STRIDE, step // STRIDE
+        if 2*frames >= window - moved:
+            logger.warning(f'hubert context {frames} leaves no frame of a {window} frame window moving by {moved} to reuse, '
+                           f'use less than {(window-moved+1)//2}. encodes the whole window')
+            return
+        if calib_audio is not None:
+            windows = [(i, calib_audio[i:i+input_len]) for i in range(0, len(calib_audio)-input_len+1, step)]
+            t = time.perf_counter()
+            ref = torch.cat([self.get_hubert_from_16k_speech(x) for _, x in windows])
+            ref_ms = (time.perf_counter()-t)*1000/len(windows)
+            self.context = frames
+            stream = HubertStream(self)
+            t = time.perf_counter()
+            out = torch.cat([stream.features(x, i) for i, x in windows])
+            ms = (time.perf_counter()-t)*1000/len(windows)
+            cos = torch.nn.functional.cosine_similarity(ref.float(), out.float(), dim=1).min().item()
+            if cos < min_cos:
+                logger.warning(f'hubert stream feature cosine {cos:.4f} < {min_cos}, encodes the whole window')
+                self.context = 0
+                return
+            logger.info(f'hubert stream with {frames} context frames: {ms:.1f}ms per step instead of {ref_ms:.1f}ms, '
+                  f'{stream.reused/len(windows):.1f} of {window} frames reused, feature cosine to the whole window {cos:.4f}')
+        self.context = frames
 
 
     @torch.no_grad()
-    def get_hubert_from_16k_speech(self, speech):
+    def get_hubert_from_16k_speech(self, speech, forward=None):
+        """forward(input_values) -> last_hidden_state, e.g. a shared BatchServer, default the model"""
+        forward = forward or partial(hubert_hidden_state, self)
         if speech.ndim == 2:
             speech = speech[:, 0]  # [T, 2] ==> [T,]
         input_values_all = self.processor(speech, return_tensors="pt", sampling_rate=16000).input_values  # [1, T]
@@ -31,14 +137,14 @@ class Audio2Feature():
                 start_idx = clip_length * i
                 end_idx = start_idx + (clip_length - stride + kernel)
             input_values = input_values_all[:, start_idx: end_idx]
-            hidden_states = self.model.forward(input_values).last_hidden_state  # [B=1, T=pts//320, hid=1024]
+            hidden_states = forward(input_values)  # [B=1, T=pts//320, hid=1024]
             res_lst.append(hidden_states[0])
         if num_iter > 0:
             input_values = input_values_all[:, clip_length * num_iter:]
         else:
             input_values = input_values_all
         if input_values.shape[1] >= kernel:  # if the last batch is shorter than kernel_size, skip it            
-            hidden_states = self.model(input_values).last_hidden_state  # [B=1, T=pts//320, hid=1024]
+            hidden_states = forward(input_values)  # [B=1, T=pts//320, hid=1024]
         res_lst.append(hidden_states[0])
         ret = torch.cat(res_lst, dim=0).cpu()  # [T, 1024]
         assert abs(ret.shape[0] - expected_T) <= 1
@@ -80,17 +186,36 @@ class Audio2Feature():
         return selected_feature,selected_idx
 
     def feature2chunks(self,feature_array,fps,batch_size,audio_feat_length = [8,8],start=0):
-        whisper_chunks = []
-        whisper_idx_multiplier = 50./fps
-        i = 0
+        """
+        get_sliced_feature of the video frames start..start+batch_size as one clamped
+        gather, (batch_size, (audio_feat_length[0]+audio_feat_length[1])*2, 1024)
+        """
+        feature_array = np.asarray(feature_array) #hubert features are a cpu tensor, no copy
         #print(f"video in {fps} FPS, audio idx in 50FPS")
-        for _ in range(batch_size):
-            # start_idx = int(i * whisper_idx_multiplier)
-            # if start_idx>=len(feature_array):
-            #     break
-            selected_feature,selected_idx = self.get_sliced_feature(feature_array= feature_array,vid_idx = i+start,audio_feat_length=audio_feat_length,fps=fps)
-            #print(f"i:{i},selected_idx {selected_idx}")
-            whisper_chunks.append(selected_feature)
-            i += 1
-
-        return whisper_chunks
+        center_idx = ((np.arange(batch_size) + start)*50/fps).astype(np.int64)
+        offsets = np.arange(-audio_feat_length[0]*2, audio_feat_length[1]*2)
+        idx = np.clip(center_idx[:, None] + offsets, 0, len(feature_array)-1)
+        return feature_array[idx].reshape(batch_size, -1, 1024)
+
+def hubert_hidden_state(audio_processor, input_values):
+    return audio_processor.model(input_values).last_hidden_state
+
+def encoder_hidden_state(audio_processor, states):
+    """transformer part of hubert on feature projection outputs"""
+    return audio_processor.model.encoder(states).last_hidden_state
+
+if __name__ == '__main__':
+    # feature2chunks against the per frame get_sliced_feature loop, no model needed
+    audio_processor = Audio2Feature.__new__(Audio2Feature)
+    feats = torch.rand(2*(10+2*128+10), 1024)
+    for batch_size in [1, 4, 8, 16, 32, 64, 128]:
+        t = time.perf_counter()
+        for _ in range(100):
+            ref = [audio_processor.get_sliced_feature(feats, i+5, fps=25)[0] for i in range(batch_size)]
+        loop_us = (time.perf_counter()-t)*1e4
+        t = time.perf_counter()
+        for _ in range(100):
+            out = audio_processor.feature2chunks(feats, 25, batch_size, start=5)
+        gather_us = (time.perf_counter()-t)*1e4
+        assert np.array_equal(np.stack(ref), out)
+        print(f"batch {batch_size:4d}: loop {loop_us:8.1f}us gather {gather_us:7.1f}us ({loop_us/gather_us:.1f}x)")
@@ -1,5 +1,6 @@
 import time
 import math
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -214,28 +215,28 @@ class Model(nn.Module):
         out = F.sigmoid(out)
         return out
 
+def reparameterize_model(model: torch.nn.Module) -> torch.nn.Module:
+    """ Method returns a model where a multi-branched structure
+        used in training is re-parameterized into a single branch
+        for inference.
+    :param model: MobileOne model in train mode.
+    :return: MobileOne model in inference mode.
+    """
+    # Avoid editing original graph
+    model = copy.deepcopy(model)
+    for module in model.modules():
+        if hasattr(module, 'reparameterize'):
+            module.reparameterize()
+    return model
+
 if __name__ == '__main__':
     import time
-    import copy
     import onnx
     import numpy as np
     onnx_path = "./unet.onnx"
 
     from thop import profile, clever_format
 
-    def reparameterize_model(model: torch.nn.Module) -> torch.nn.Module:
-        """ Method returns a model where a multi-branched structure
-            used in training is re-parameterized into a single branch
-            for inference.
-        :param model: MobileOne model in train mode.
-        :return: MobileOne model in inference mode.
-        """
-        # Avoid editing original graph
-        model = copy.deepcopy(model)
-        for module in model.modules():
-            if hasattr(module, 'reparameterize'):
-                module.reparameterize()
-        return model
     device = torch.device("cuda")
     def check_onnx(torch_out, torch_in, audio):
         onnx_model = onnx.load(onnx_path)
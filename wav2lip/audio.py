@@ -50,6 +50,61 @@ def melspectrogram(wav):
         return _normalize(S)
     return S
 
+class StreamingMel:
+    """
+    melspectrogram() columns of a window sliding over one audio stream.
+    preemphasis keeps its filter state and only runs on new samples, stft columns are
+    computed once per position in the stream and cached. columns of the next window are
+    at the same positions only when the window moves by a multiple of the hop, otherwise
+    just the columns asked for are computed. columns whose frame touches
+    the window edges (first sample, padding of the centered stft) differ from
+    melspectrogram(window), columns() returns None for them.
+    """
+    def __init__(self):
+        assert not hp.use_lws
+        self.hop = get_hop_size()
+        self.n_fft = hp.n_fft
+        window = librosa.filters.get_window('hann', hp.win_size, fftbins=True)
+        self.window = librosa.util.pad_center(window, size=hp.n_fft)
+        self.reset(0)
+
+    def reset(self, start):
+        self.pre = np.zeros(0) #preemphasized stream from sample pre_start on
+        self.pre_start = start
+        self.zi = np.zeros(1) #lfilter state
+        self.cols = {} #frame start sample: normalized mel column
+
+    def feed(self, wav, start):
+        """wav: window of the stream beginning at sample start, only its unseen tail is filtered"""
+        end = self.pre_start + len(self.pre)
+        if start < self.pre_start or start > end: #gap in the stream, start over
+            self.reset(start)
+            end = start
+        new = wav[end-start:]
+        if hp.preemphasize:
+            new, self.zi = signal.lfilter([1, -hp.preemphasis], [1], new, zi=self.zi)
+        keep = start - self.pre_start #only the current window is needed later
+        self.pre = np.concatenate([self.pre[keep:], new])
+        self.pre_start = start
+        self.cols = {pos: col for pos, col in self.cols.items() if pos > start}
+
+    def columns(self, start, length, cols):
+        """[num_mels, len(cols)] columns cols of melspectrogram(window), None if one touches the edges"""
+        positions = [start + t*self.hop - self.n_fft//2 for t in cols]
+        if positions[0] <= start or positions[-1] + self.n_fft > start + length:
+            return None
+        missing = [pos for pos in positions if pos not in self.cols]
+        if missing:
+            offsets = np.array(missing) - self.pre_start
+            frames = self.pre[offsets[:, None] + np.arange(self.n_fft)].T #[n_fft, frames] like librosa
+            D = np.fft.rfft(self.window[:, None] * frames, axis=-2)
+            S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+            if hp.signal_normalization:
+                S = _normalize(S)
+            for i, pos in enumerate(missing):
+                self.cols[pos] = S[:, i]
+        return np.stack([self.cols[pos] for pos in positions], axis=1)
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")